@@ -43,6 +43,22 @@ def set_ownership(methods):
     set_attribute(methods, '_creates', True)
 
 
+def set_threaded(methods):
+    """Release the GIL when calling methods.
+
+    Sets `clsmethod.__release_gil__' (cppyy based PyROOT, 6.22+), or
+    `clsmethod._threaded' (legacy PyROOT), whichever is supported.
+
+    """
+    for method in methods:
+        for attr in ('__release_gil__', '_threaded'):
+            try:
+                setattr(method, attr, True)
+                break
+            except (AttributeError, TypeError):
+                continue
+
+
 def py_next(iterator):
     el = iterator.cpp_next()        # call C++ version of cls.next()
     if el:
@@ -72,6 +88,15 @@ del matches, typ
 set_ownership(_creators)
 
 
+# I/O heavy methods, let other Python threads run meanwhile
+_io_methods = [
+    ROOT.TFile.Open,
+    ROOT.TKey.ReadObj
+]
+
+set_threaded(_io_methods)
+
+
 _root_containers = [
     ROOT.TCollection
 ]
@@ -30,3 +30,352 @@ def th12hist(hist, edges=True):
     assert (hist.GetDimension() == 1)
     from utils import thnbins, thn2array
     return (thn2array(hist), thnbins(hist, edges=edges, overflow=True)[1][1:])
+
+
+def taxisedges(axis):
+    """Return bin edges of an axis (nbins + 1)"""
+    from utils import taxisbins
+    # low edge of the overflow bin is the upper edge of the last bin
+    return taxisbins(axis, overflow=True)[1][1:]
+
+
+def thn2arrays(hist, err=True, copy=False):
+    """Convert a 1, 2, or 3D histogram to arrays.
+
+    Returns the list of bin edges of every axis, the bin contents
+    indexed as [z][y][x], and the bin errors (None unless err).  The
+    contents are a view of the histogram storage unless copy is set
+    (or the storage is not supported), so they follow changes to the
+    histogram, and must not outlive it.  Errors are always a copy.
+
+    """
+    import numpy as np
+    from ROOT import TH1
+    from utils import thncells, thncellshape, thn2array
+    axes = (hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis())
+    edges = [taxisedges(axis) for axis in axes[:hist.GetDimension()]]
+    cells = thncells(hist, copy=copy)
+    if cells is None:
+        val = thn2array(hist, err=True, pair=True, shaped=True)
+        return edges, val[..., 0], val[..., 1] if err else None
+    shape = thncellshape(hist)
+    inner = (slice(1, -1),) * len(shape)
+    content, error = cells.reshape(shape)[inner], None
+    if err and hist.GetBinErrorOption() != TH1.kNormal:
+        error = thn2array(hist, err=True, pair=True, shaped=True)[..., 1]
+    elif err:
+        sumw2 = thncells(hist, sumw2=True)
+        if sumw2 is None:
+            sumw2 = np.abs(cells)
+        error = np.sqrt(sumw2, dtype=float).reshape(shape)[inner]
+    return edges, content, error
+
+
+_profile_types = ('TProfile', 'TProfile2D', 'TProfile3D')
+
+
+def tprofile2arrays(prof, err=True):
+    """Convert a profile to arrays, see thn2arrays(..).
+
+    The profile is projected to a histogram of means (with errors as
+    set by the profile's error option), so the arrays are a copy.
+
+    """
+    import ROOT
+    dim = prof.GetDimension()
+    name = '{}_r2mpl'.format(prof.GetName())
+    if dim == 1:
+        proj = prof.ProjectionX(name, 'e')
+    elif dim == 2:
+        proj = prof.ProjectionXY(name, 'e')
+    else:
+        proj = prof.ProjectionXYZ(name, 'e')
+    proj.SetDirectory(0)
+    ROOT.SetOwnership(proj, True)
+    res = thn2arrays(proj, err=err, copy=True)
+    del proj
+    return res
+
+
+def tgraph2arrays(graph, copy=False):
+    """Convert a graph to arrays appropriate for Axes.errorbar.
+
+    Returns x, y, x errors, and y errors.  Errors are None for graphs
+    without errors, and a (low, high) pair for asymmetric errors.  The
+    arrays are views of the graph's buffers unless copy is set.
+
+    """
+    from utils import rbuffer
+    npoints = graph.GetN()
+
+    def view(buf):
+        return rbuffer(buf, npoints, copy=copy)
+
+    x, y = view(graph.GetX()), view(graph.GetY())
+    if graph.InheritsFrom('TGraphAsymmErrors'):
+        xerr = (view(graph.GetEXlow()), view(graph.GetEXhigh()))
+        yerr = (view(graph.GetEYlow()), view(graph.GetEYhigh()))
+    elif graph.InheritsFrom('TGraphErrors'):
+        xerr, yerr = view(graph.GetEX()), view(graph.GetEY())
+    else:
+        xerr, yerr = None, None
+    return x, y, xerr, yerr
+
+
+def root2arrays(obj, copy=False):
+    """Convert a histogram, profile, or graph to arrays.
+
+    See thn2arrays(..), tprofile2arrays(..), and tgraph2arrays(..).
+
+    """
+    if any(obj.InheritsFrom(cls) for cls in _profile_types):
+        return tprofile2arrays(obj)
+    elif obj.InheritsFrom('TH1'):
+        return thn2arrays(obj, copy=copy)
+    elif obj.InheritsFrom('TGraph'):
+        return tgraph2arrays(obj, copy=copy)
+    raise TypeError('Cannot convert {} to arrays'.format(obj.ClassName()))
+
+
+def th22pcolormesh(hist):
+    """Convert 2D histogram to arrays appropriate for Axes.pcolormesh.
+
+    Returns the x and y bin edges, and the bin contents indexed as
+    [y][x]; empty bins are masked (like the `colz' draw option).
+
+    """
+    assert (hist.GetDimension() == 2)
+    import numpy as np
+    if any(hist.InheritsFrom(cls) for cls in _profile_types):
+        edges, content, error = tprofile2arrays(hist, err=False)
+    else:
+        edges, content, error = thn2arrays(hist, err=False, copy=True)
+    return edges[0], edges[1], np.ma.masked_equal(content, 0)
+
+
+def pad_arrays(plot, normalised=False, stack=False):
+    """Convert 1D histograms on a pad to content and error arrays.
+
+    Returns a list of (edges, contents, errors) for every histogram;
+    contents (and errors) are added cumulatively when stacked (errors
+    in quadrature), and then scaled to unit area when normalised, like
+    Rplot (TH1::DrawNormalized on the stacked copies).
+
+    """
+    import numpy as np
+    res = [root2arrays(hist, copy=True) for hist in plot]
+    res = [(edges[0], content, error) for edges, content, error in res]
+    sumw = [hist.GetSumOfWeights() for hist in plot]
+    if stack and len(res) > 1 and \
+       len(set(content.size for edges, content, error in res)) == 1:
+        contents = np.cumsum([content for edges, content, error in res],
+                             axis=0)
+        errors = np.sqrt(np.cumsum([error**2 for edges, content, error
+                                    in res], axis=0))
+        res = [(edges, contents[i], errors[i])
+               for i, (edges, content, error) in enumerate(res)]
+        sumw = np.cumsum(sumw)
+    if normalised:
+        res = [(edges, content / sumw[i], error / sumw[i])
+               if sumw[i] > 0 else (edges, content, error)
+               for i, (edges, content, error) in enumerate(res)]
+    return res
+
+
+class Mplot(object):
+    """Plotter class for matplotlib, with the same interface as Rplot.
+
+    Pads are drawn on a matplotlib Figure (with the Agg backend), so
+    neither a display, nor ROOT graphics are needed.  Every plottable
+    is drawn with one artist: histograms with the `hist' option as
+    steps (Axes.stairs), with the `e' or `p' options as error bars,
+    2D histograms as a colour mesh, and graphs as error bars.
+
+    """
+
+    fill_colours = ('tab:blue', 'tab:red', 'tab:gray', 'tab:green',
+                    'tab:purple', 'tab:orange', 'tab:cyan', 'tab:olive')
+    line_colours = ('navy', 'darkred', 'black', 'darkgreen',
+                    'darkmagenta', 'darkorange', 'darkcyan', 'teal')
+
+    markers = ('.', '.', 'o', 'v', '^', 'o', '+', '*', 'x', '.', 'o', 's',
+               'o', 's', '^', 'v')
+
+    grid = (1, 1)
+    size = (400, 400)
+    pad_size = (400, 300)
+    dpi = 100
+    alpha = 0.05
+    plots = []
+    canvas = None
+    style = True
+    stack = False
+    shrink2fit = True
+    legend = []
+
+    def __init__(self, xgrid=1, ygrid=1, width=None, height=None):
+        self.grid = (xgrid, ygrid)
+        self.nplots = xgrid * ygrid
+        self.plots = []
+        width = width or self.pad_size[0] * xgrid
+        height = height or self.pad_size[1] * ygrid
+        self.size = (width, height)
+
+    def prep_canvas(self, name='canvas', title=''):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.canvas = Figure(figsize=(self.size[0] / float(self.dpi),
+                                      self.size[1] / float(self.dpi)),
+                             dpi=self.dpi)
+        FigureCanvasAgg(self.canvas)
+        if title:
+            self.canvas.suptitle(title)
+        # same order as pads in a divided TCanvas
+        self.axes = self.canvas.subplots(self.grid[1], self.grid[0],
+                                         squeeze=False).ravel()
+        return self.canvas
+
+    def add_legend(self, legend, option):
+        """Add legends to all pads.
+
+        legend -- legend location (e.g. 'upper right', see Axes.legend)
+        option -- legend option, kept for compatibility with Rplot
+
+        """
+        self.legend = [legend] * self.nplots
+        self.leg_opt = option
+
+    def get_style(self, num, opts):
+        style = {}
+        if self.style:
+            num = num % len(self.fill_colours)
+            if 'hist' in opts:
+                style.update(facecolor=self.fill_colours[num],
+                             edgecolor=self.line_colours[num],
+                             alpha=1 - num*self.alpha, fill=True)
+            else:
+                style.update(color=self.line_colours[num],
+                             marker=self.markers[num], markersize=2)
+        return style
+
+    def draw_plottable(self, ax, plottable, arrays, opts, num):
+        """Draw a plottable (with its converted arrays) on an Axes"""
+        label = plottable.GetTitle() or plottable.GetName()
+        opts = opts.lower().replace('same', '')
+        if plottable.InheritsFrom('TH2'):
+            xedges, yedges, content = th22pcolormesh(plottable)
+            return ax.pcolormesh(xedges, yedges, content, label=label)
+        style = self.get_style(num, opts)
+        if plottable.InheritsFrom('TGraph'):
+            x, y, xerr, yerr = arrays
+            style.setdefault('marker', '.')
+            linestyle = '-' if 'l' in opts or 'c' in opts else ''
+            return ax.errorbar(x, y, xerr=xerr, yerr=yerr, label=label,
+                               linestyle=linestyle, **style)
+        edges, content, error = arrays
+        if 'hist' in opts:
+            return ax.stairs(content, edges, label=label, **style)
+        centres = (edges[1:] + edges[:-1]) / 2.0
+        if 'e' in opts:
+            return ax.errorbar(centres, content, yerr=error, linestyle='',
+                               label=label, **style)
+        style.setdefault('marker', '.')
+        return ax.errorbar(centres, content, label=label, linestyle='',
+                           **style)
+
+    def draw_pad(self, i, plot, drawopts, normalised=False):
+        """Draw plot (plottable, or list of plottables) on pad i"""
+        ax = self.axes[i]
+        ax.clear()
+        if not plot:
+            ax.set_axis_off()
+            return
+        ax.set_axis_on()
+        if not isinstance(plot, (list, tuple)):
+            plot = [plot]
+        plot = [pl for pl in filter(None, plot)]
+        if isinstance(drawopts, str):
+            drawopts = [drawopts] * len(plot)
+        if len(plot) != len(drawopts):
+            print('# plottables ≠ # options!')
+            return
+        hists = [pl for pl in plot if pl.InheritsFrom('TH1') and
+                 pl.GetDimension() == 1]
+        arrays = dict(zip([id(pl) for pl in hists],
+                          pad_arrays(hists, normalised, self.stack)))
+        arrays.update((id(pl), tgraph2arrays(pl, copy=True))
+                      for pl in plot if pl.InheritsFrom('TGraph'))
+        order = range(len(plot))
+        if self.stack:          # largest first, like Rplot
+            order = reversed(order)
+        for num in order:
+            self.draw_plottable(ax, plot[num], arrays.get(id(plot[num])),
+                                drawopts[num], num)
+        if self.shrink2fit:
+            ax.margins(y=0.03)
+        xtitle = plot[0].GetXaxis().GetTitle()
+        ytitle = plot[0].GetYaxis().GetTitle()
+        if xtitle:
+            ax.set_xlabel(xtitle)
+        if ytitle:
+            ax.set_ylabel(ytitle)
+        if self.legend:
+            ax.legend(loc=self.legend[i])
+
+    def draw_hist(self, plots, drawopts, normalised=False):
+        """Draw plots on the grid of pads, see Rplot.draw_hist(..)"""
+        diff = len(plots) - self.nplots
+        if diff > 0:
+            print('# plots ({}) > # pads ({})!'
+                  .format(len(plots), self.nplots))
+            return
+        elif diff < 0:
+            # insert blanks
+            plots += [None] * (-diff)
+        if not self.canvas:
+            self.prep_canvas()
+        if isinstance(drawopts, str):
+            drawopts = [drawopts] * len(plots)
+        if len(plots) != len(drawopts):
+            print('# plots ({}) ≠ # options ({})!'
+                  .format(len(plots), len(drawopts)))
+            return
+        self.plots = plots
+        for i, plot in enumerate(plots):
+            self.draw_pad(i, plot, drawopts[i], normalised)
+        return self.canvas
+
+    def draw_graph(self, *args, **kwargs):
+        """Same as draw_hist(..)."""
+        return self.draw_hist(*args, **kwargs)
+
+    def export(self, pages, drawopts, filename, normalised=False):
+        """Draw pages of plots, and save them to file(s).
+
+        See Rplot.export(..), multi-page files are only supported for
+        PDF.  Returns the list of files written.
+
+        """
+        perpage = filename.find('{') >= 0
+        if not perpage and len(pages) > 1 and not filename.endswith('.pdf'):
+            raise ValueError('Multi-page output needs PDF, '
+                             'or a `{{}}\' in file name: {}'.format(filename))
+        if not self.canvas:
+            self.prep_canvas()
+        if perpage:
+            files = []
+            for i, plots in enumerate(pages):
+                self.draw_hist(list(plots), drawopts, normalised)
+                files.append(filename.format(i))
+                self.canvas.savefig(files[-1])
+            return files
+        if len(pages) == 1:
+            self.draw_hist(list(pages[0]), drawopts, normalised)
+            self.canvas.savefig(filename)
+        else:
+            from matplotlib.backends.backend_pdf import PdfPages
+            with PdfPages(filename) as pdf:
+                for plots in pages:
+                    self.draw_hist(list(plots), drawopts, normalised)
+                    pdf.savefig(self.canvas)
+        return [filename]
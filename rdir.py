@@ -4,6 +4,10 @@
 """
 
 import os.path
+import threading
+from collections import OrderedDict
+
+from rprof import profiled
 
 
 class pathspec(object):
@@ -16,6 +20,7 @@ class pathspec(object):
     Paths in other root files have to be preceded by the file name and
     a colon:
     - file path: myfile.root:/dir1/dir2
+    - URL: root://host:1094//path/myfile.root:/dir1/dir2
 
     See: TDirectoryFile::cd(..) in ROOT docs
 
@@ -32,58 +37,165 @@ class pathspec(object):
     Pathname parsing rules:
 
     - Colons in file names are not allowed, since it is used to split
-      the path into file path, and root object path.  Probably using
-      some kind of an URL library can improve this.
+      the path into file path, and root object path.  For URLs (with
+      a scheme, e.g. root://, or file://), only colons in the path
+      part of the URL are considered, so host ports are allowed.
 
     - When colons are being used, no other assumption is made about
       the ROOT file other than the above mentioned
       limitation. However, when only file paths are given (w/o the
       trailing colon), it is assumed to be path to a ROOT file if the
-      path ends in `.root', path to a ROOT object inside a ROOT file
-      otherwise.
+      path ends in `.root' (or is a URL), path to a ROOT object inside
+      a ROOT file otherwise.
+
+    pathspec objects are immutable, and interned: the same path string
+    returns the same object (for the most recently used paths), so a
+    path is parsed only once.  The file and object paths are split on
+    creation, other properties are computed when accessed.
 
     """
 
-    # declare properties for pydoc
-    path, rfile, rpath = None, None, None
-    relative, norfile, norpath = None, None, None
-    rfile_basename, rfile_dirname, rfile_split = None, None, None
-    rpath_basename, rpath_dirname, rpath_split = None, None, None
-
-    def __init__(self, path):
-        self.path = path
-        if path.find(':') < 0:
-            if path.find('.root') < 0:
-                self.rfile = ''
-                self.rpath = path
+    __slots__ = ('_path', '_scheme', '_rfile', '_rpath')
+
+    # interned instances, least recently used first
+    _interned = OrderedDict()
+    _interned_size = 4096
+    _interned_lock = threading.Lock()
+
+    def __new__(cls, path):
+        if isinstance(path, pathspec):
+            return path
+        with cls._interned_lock:
+            try:
+                self = cls._interned.pop(path)
+            except KeyError:
+                self = None
+            if self is not None:
+                cls._interned[path] = self
+                return self
+        self = object.__new__(cls)
+        self._parse(path)
+        with cls._interned_lock:
+            cls._interned[path] = self
+            while len(cls._interned) > cls._interned_size:
+                cls._interned.popitem(last=False)
+        return self
+
+    def _parse(self, path):
+        self._path = path
+        scheme = path.find('://')
+        if scheme > 0 and path[:scheme].isalnum():
+            self._scheme = path[:scheme]
+            # look for the colon after the host, e.g. root://host:port/
+            pathstart = path.find('/', scheme + 3)
+            sep = path.find(':', pathstart) if pathstart >= 0 else -1
+        else:
+            self._scheme = ''
+            sep = path.find(':')
+        if sep < 0:
+            if self._scheme or path.find('.root') >= 0:
+                rfile, rpath = path, ''
             else:
-                self.rfile = path
-                self.rpath = ''
+                rfile, rpath = '', path
         else:
-            self.rfile, self.rpath = path.split(':', 1)
-        self.rpath = self.rpath.rstrip('/')
-        self.norfile = not self.rfile
-        self.norpath = not self.rpath
-        self.relative = self.rpath.find('../') == 0 or \
-                        self.rpath.find('/') > 0
-        if self.rfile and self.relative:
+            rfile, rpath = path[:sep], path[sep+1:]
+        self._rfile, self._rpath = rfile, rpath.rstrip('/')
+        if self._rfile and self.relative:
             raise ValueError('Relative path not allowed with file specifier')
 
-        # utilities
-        self.rfile_dirname = os.path.dirname(self.rfile)
-        self.rfile_basename = os.path.basename(self.rfile)
-        self.rfile_split = os.path.split(self.rfile)
-        self.rpath_split = os.path.split(self.rpath)
-        self.rpath_basename = os.path.basename(self.rpath)
-        self.rpath_dirname = os.path.dirname(self.rpath)
+    def __getnewargs__(self):
+        return (self._path,)
 
     def __str__(self):
-        return self.path
+        return self._path
+
+    def __repr__(self):
+        return 'pathspec({!r})'.format(self._path)
+
+    def __eq__(self, other):
+        if not isinstance(other, pathspec):
+            return NotImplemented
+        return self._path == other._path
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        return res if res is NotImplemented else not res
+
+    def __hash__(self):
+        return hash(self._path)
+
+    @property
+    def path(self):
+        """Path as given"""
+        return self._path
+
+    @property
+    def scheme(self):
+        """URL scheme of the file (e.g. root), empty if not a URL"""
+        return self._scheme
+
+    @property
+    def rfile(self):
+        """File path (or URL), empty if not specified"""
+        return self._rfile
+
+    @property
+    def rpath(self):
+        """Object path (w/o trailing slash) inside the file"""
+        return self._rpath
+
+    @property
+    def norfile(self):
+        return not self._rfile
+
+    @property
+    def norpath(self):
+        return not self._rpath
+
+    @property
+    def relative(self):
+        return self._rpath.find('../') == 0 or self._rpath.find('/') > 0
+
+    @property
+    def rfile_dirname(self):
+        return os.path.dirname(self._rfile)
+
+    @property
+    def rfile_basename(self):
+        return os.path.basename(self._rfile)
 
+    @property
+    def rfile_split(self):
+        return os.path.split(self._rfile)
 
+    @property
+    def rpath_dirname(self):
+        return os.path.dirname(self._rpath)
+
+    @property
+    def rpath_basename(self):
+        return os.path.basename(self._rpath)
+
+    @property
+    def rpath_split(self):
+        return os.path.split(self._rpath)
+
+    @property
+    def parent(self):
+        """Path specification one level up (in the same file)"""
+        return pathspec('{}:{}'.format(self._rfile, self.rpath_dirname))
+
+
+from collections import namedtuple
 from fixes import ROOT
 from ROOT import gROOT, gDirectory
-from utils import is_type
+from utils import is_type, is_dir
+
+
+keyinfo = namedtuple('keyinfo',
+                     'file dirpath name classname cycle nbytes objlen')
+keyinfo.__doc__ = """Key metadata, as kept in the Rdir index; the key is
+found in the directory dirpath (relative to the file), see Rdir.key(..)"""
 
 
 class savepwd(object):
@@ -102,19 +214,266 @@ class savepwd(object):
         self.pwd.cd()
 
 
+def _in_use(rdir):
+    """Does directory (or a subdirectory) hold objects in memory?"""
+    for obj in rdir.GetList():
+        if not isinstance(obj, ROOT.TDirectory) or _in_use(obj):
+            return True
+    return False
+
+
+class Rfilepool(object):
+    """Bounded pool of open ROOT files.
+
+    Files are opened when needed, and when more than maxopen files are
+    open, the least recently used ones are closed.  Closed files are
+    reopened when they are accessed again.  Files with objects in
+    memory (e.g. histograms, or trees read from them), or with the
+    current directory, are never closed.
+
+    Worker threads get extra handles to a file with checkout(..), and
+    return them with checkin(..).  Extra handles count towards
+    maxopen, returned handles are kept for reuse, and are closed
+    before the shared ones.
+
+    """
+
+    def __init__(self, maxopen=256):
+        self.maxopen = maxopen
+        self._open = OrderedDict()      # least recently used first
+        self._names = OrderedDict()     # all files, in order (added or not)
+        self._spare = []                # returned extra handles, LRU first
+        self._nout = 0                  # extra handles checked out
+        self._lock = threading.RLock()
+
+    @property
+    def names(self):
+        """Names of all files in the pool, open or not"""
+        return [name for name, added in self._names.items() if added]
+
+    def handles(self):
+        """Return list of open files, in the order of names"""
+        with self._lock:
+            return [self._open[name] for name in self._names
+                    if name in self._open]
+
+    def reserve(self, fnames):
+        """Keep the order of files that are added later, in any order"""
+        with self._lock:
+            for fname in fnames:
+                self._names.setdefault(fname, False)
+
+    def __contains__(self, fname):
+        return bool(self._names.get(fname))
+
+    def isopen(self, fname):
+        return fname in self._open
+
+    def _use(self, fname, rfile):
+        """Mark file as most recently used, and close excess files"""
+        self._names[fname] = True
+        self._open.pop(fname, None)
+        self._open[fname] = rfile
+        self._evict(fname)
+        return rfile
+
+    def _evict(self, keep=None):
+        """Close least recently used files in excess of maxopen"""
+        excess = len(self._open) + len(self._spare) + self._nout - \
+            self.maxopen
+        spare = []
+        for name, old in self._spare:   # extra handles first
+            if excess > 0 and not _in_use(old):
+                old.Close()
+                excess -= 1
+            else:
+                spare.append((name, old))
+        self._spare = spare
+        if excess <= 0:
+            return
+        pwd = gDirectory.GetFile()
+        pwd = pwd.GetName() if pwd else None
+        for name in list(self._open):
+            if excess <= 0:
+                break
+            old = self._open[name]
+            if name in (keep, pwd) or _in_use(old):
+                continue
+            del self._open[name]
+            old.Close()
+            excess -= 1
+
+    def add(self, rfile):
+        """Add an open file to the pool"""
+        with self._lock:
+            return self._use(rfile.GetName(), rfile)
+
+    def get(self, fname):
+        """Return open file, (re)open it if necessary (None on failure)"""
+        with self._lock:
+            rfile = self._open.get(fname)
+            if not (rfile and rfile.IsOpen()):
+                with savepwd():
+                    rfile = ROOT.TFile.Open(fname, 'read')
+                if not rfile or rfile.IsZombie():
+                    return None
+            return self._use(fname, rfile)
+
+    def checkout(self, fname):
+        """Return an extra handle to file, for use by one thread (None
+        on failure), see checkin(..)"""
+        with self._lock:
+            self._nout += 1
+            for i in reversed(range(len(self._spare))):
+                if self._spare[i][0] == fname:
+                    return self._spare.pop(i)[1]
+            self._evict()
+        with savepwd():
+            rfile = ROOT.TFile.Open(fname, 'read')
+        if not rfile or rfile.IsZombie():
+            with self._lock:
+                self._nout -= 1
+            return None
+        return rfile
+
+    def checkin(self, fname, rfile):
+        """Return extra handle to the pool, see checkout(..)"""
+        with self._lock:
+            self._nout -= 1
+            self._spare.append((fname, rfile))
+            self._evict()
+
+    def close(self):
+        """Close all files that are not in use"""
+        with self._lock:
+            for name, rfile in list(self._open.items()):
+                if not _in_use(rfile):
+                    del self._open[name]
+                    rfile.Close()
+            spare = [(name, rfile) for name, rfile in self._spare
+                     if _in_use(rfile)]
+            for name, rfile in self._spare:
+                if not _in_use(rfile):
+                    rfile.Close()
+            self._spare = spare
+
+
 class Rdir(object):
-    """Global filesystem like directory hierarchy for a ROOT session."""
+    """Global filesystem like directory hierarchy for a ROOT session.
+
+    When the optional key index is enabled, directory listings are
+    read once and kept in a flat map from the full path of every
+    object (file:/path/to/obj) to its key metadata (see keyinfo).
+    Directories are indexed lazily, on first access.  The files are
+    assumed not to change while the index is in use, otherwise call
+    Rdir.clear_index().
+
+    Files can be opened in the background (prefetch), in which case
+    they are added as they become available, see Rdir.poll(..).
+
+    At most maxopen files are kept open, see Rfilepool.  The index
+    does not refer to open files, so it is kept for closed files too.
+
+    """
 
-    files = []
+    index = None
+    nworkers = 1
+    nopeners = 8
+    maxopen = 256
 
-    def __init__(self, files):
+    def __init__(self, files, index=False, prefetch=False):
+        """Open ROOT files.
+
+        files    -- list of file names
+        index    -- maintain a key index
+        prefetch -- open files concurrently in the background, and
+                    read ahead the keys of their top level directories
+                    (see poll(..))
+
+        """
+        for f in files:
+            if not isinstance(f, str):
+                raise TypeError('Expected string, {} found'.format(type(f)))
+        self.pool = Rfilepool(self.maxopen)
+        self._pending = OrderedDict()
+        self.errors = []
+        self._lock = threading.Lock()
+        if index:
+            self.clear_index()
+        if prefetch and files:
+            self._prefetch(files)
+        else:
+            with savepwd():
+                for f in files:
+                    self._add_file(ROOT.TFile.Open(f, 'read'))
+
+    def _add_file(self, rfile):
+        if rfile:
+            self.pool.add(rfile)
+
+    @property
+    def files(self):
+        """Open files, in the order they were given"""
+        return self.pool.handles()
+
+    @property
+    def filenames(self):
+        """Names of all files, including those closed by the pool"""
+        return self.pool.names
+
+    def _prefetch(self, files):
+        """Open files with a pool of background threads"""
+        from concurrent.futures import ThreadPoolExecutor
+        ROOT.EnableThreadSafety()
+        executor = ThreadPoolExecutor(self.nopeners)
+        self.pool.reserve(files)        # files in order, as they finish
+        for fname in files:
+            self._pending[fname] = executor.submit(self._open_ahead, fname)
+        executor.shutdown(wait=False)  # threads finish pending work
+
+    def _open_ahead(self, fname):
+        """Open file, and read keys of top level directories (in a thread)"""
         with savepwd():
-            self.files = []
-            for f in files:
-                if isinstance(f, str):
-                    self.files.append(ROOT.TFile.Open(f, 'read'))
-                else:
-                    raise TypeError('Expected string, {} found'.format(type(f)))
+            rfile = ROOT.TFile.Open(fname, 'read')
+        if not rfile or rfile.IsZombie():
+            raise IOError('Cannot open file: {}'.format(fname))
+        for key in rfile.GetListOfKeys():
+            if is_dir(key):
+                rfile.Get(key.GetName())  # reads the key list
+        if self.index is not None:
+            self._listing(rfile)
+        return rfile
+
+    def poll(self, wait=False, fnames=None):
+        """Add files that were opened in the background.
+
+        wait   -- block until the files are open
+        fnames -- only wait for these files (default: all)
+
+        Returns list of (file name, error message) for files that
+        failed since the last call, they are also kept in errors.
+
+        """
+        from concurrent.futures import wait as wait_for
+        if wait and self._pending:
+            wait_for([future for fname, future in self._pending.items()
+                      if fnames is None or fname in fnames])
+        failed = []
+        for fname, future in list(self._pending.items()):
+            if not future.done():
+                continue
+            del self._pending[fname]
+            try:
+                self._add_file(future.result())
+            except Exception as err:
+                failed.append((fname, str(err)))
+        self.errors += failed
+        return failed
+
+    def clear_index(self):
+        """Reset the key index (enables it, if it wasn't)"""
+        self.index = {}
+        self._listings = {}
 
     def get_dir(self, path=None):
         """Return directory from path.
@@ -127,15 +486,82 @@ class Rdir(object):
             return gDirectory.GetDirectory('')
         else:
             path = pathspec(path)
+            if path.rfile in self._pending:
+                self.poll(wait=True, fnames=[path.rfile])
             with savepwd():
                 if path.rfile:  # need to change to correct file first
-                    if path.rfile not in [f.GetName() for f in self.files]:
-                        # opening a file changes dir to the new file
-                        self.files += [ROOT.TFile.Open(path.rfile, 'read')]
-                    else:
-                        gROOT.cd('{}:'.format(path.rfile))
+                    rfile = self.pool.get(path.rfile)
+                    if not rfile:
+                        return None
+                    rfile.cd()
                 return gDirectory.GetDirectory(path.rpath)
 
+    def _listing(self, rdir):
+        """Return key metadata for directory, index it if necessary.
+
+        The index is also filled by the threads opening files in the
+        background, so it is only updated with the lock held.
+
+        """
+        with self._lock:
+            return self._listing_locked(rdir)
+
+    def _listing_locked(self, rdir):
+        dirpath = rdir.GetPath()
+        try:
+            return self._listings[dirpath]
+        except KeyError:
+            pass
+        prefix = dirpath.rstrip('/')
+        fname = rdir.GetFile().GetName()
+        relpath = dirpath[len(fname)+1:].strip('/')
+        infos = []
+        for key in rdir.GetListOfKeys():
+            info = keyinfo(fname, relpath, key.GetName(), key.GetClassName(),
+                           key.GetCycle(), key.GetNbytes(), key.GetObjlen())
+            infos.append(info)
+            objpath = '{}/{}'.format(prefix, info.name)
+            last = self.index.get(objpath)
+            if not last or last.cycle < info.cycle:  # like TDirectory::GetKey
+                self.index[objpath] = info
+        self._listings[dirpath] = infos
+        return infos
+
+    def _ls_index(self, path=None):
+        """Return key metadata for path, using the index"""
+        spec = pathspec(path) if path else None
+        if spec and spec.rfile:  # full path, try w/o changing directory
+            fullpath = '{}:/{}'.format(spec.rfile, spec.rpath.lstrip('/'))
+            if fullpath in self._listings:
+                return self._listings[fullpath]
+            elif fullpath in self.index:
+                return [self.index[fullpath]]
+        rdir = self.get_dir(path)
+        if rdir:
+            return self._listing(rdir)
+        # not a dir, or does not exist; try again from one level up
+        rdir = self.get_dir(spec.parent)
+        if not rdir:
+            return []
+        self._listing(rdir)
+        info = self.index.get('{}/{}'.format(rdir.GetPath().rstrip('/'),
+                                             spec.rpath_basename))
+        return [info] if info else []
+
+    def key(self, info):
+        """Return key for key metadata (reopens the file if necessary)"""
+        rdir = self.pool.get(info.file)
+        if rdir and info.dirpath:
+            rdir = rdir.GetDirectory(info.dirpath)
+        return rdir.GetKey(info.name, info.cycle) if rdir else None
+
+    def _ls_infos(self, path=None, robj_t=None):
+        infos = self._ls_index(path)
+        if robj_t:
+            infos = [info for info in infos if ROOT.TClass.GetClass(
+                info.classname).InheritsFrom(robj_t.Class())]
+        return infos
+
     def ls(self, path=None, robj_t=None, robj_p=None):
         """Return list of key(s) in path.
 
@@ -155,11 +581,16 @@ class Rdir(object):
         robj_p -- custom filter function that takes ROOT.TKey
 
         """
+        if self.index is not None:
+            keys = [self.key(info) for info in self._ls_infos(path, robj_t)]
+            if robj_p:
+                keys = filter(robj_p, keys)
+            return keys
         rdir = self.get_dir(path)
         if not rdir:            # not a dir, or does not exist
             path = pathspec(path)
             # try again from one level up
-            rdir = self.get_dir('{}:{}'.format(path.rfile, path.rpath_dirname))
+            rdir = self.get_dir(path.parent)
             # FIXME: should be: while not rdir: keep trying
             if rdir:            # exists, but not a directory
                 keys = [rdir.GetKey(path.rpath_basename)]
@@ -180,19 +611,72 @@ class Rdir(object):
         For documentation on arguments, see Rdir.ls(..)
 
         """
+        if self.index is not None and not robj_p:
+            return [info.name for info in self._ls_infos(path, robj_t)]
         return [k.GetName() for k in self.ls(path, robj_t, robj_p)]
 
-    def read(self, path=None, robj_t=None, robj_p=None, metainfo=False):
+    def _read_keys(self, keys):
+        """Read (file, dir, name, cycle) keys with private file handles"""
+        handles, objs = {}, []
+        try:
+            for fname, rpath, name, cycle in keys:
+                if fname not in handles:
+                    rfile = self.pool.checkout(fname)
+                    if not rfile:
+                        raise IOError('Cannot open file: {}'.format(fname))
+                    handles[fname] = rfile
+                rdir = handles[fname]
+                if rpath:
+                    rdir = rdir.GetDirectory(rpath)
+                objs.append(rdir.GetKey(name, cycle).ReadObj())
+        finally:
+            for fname, rfile in handles.items():
+                self.pool.checkin(fname, rfile)
+        return objs
+
+    def _read_concurrent(self, keys, fnames, nworkers):
+        """Read keys with a pool of worker threads, keeping the order.
+
+        Reading the same TFile from several threads is not safe, so
+        every worker reads through its own handle to the file, taken
+        from the pool (see Rfilepool.checkout(..)).  The handles are
+        reused by later reads, and count towards maxopen; handles that
+        objects read depend on (e.g. trees) are not closed.
+
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        ROOT.EnableThreadSafety()
+        keys = [(fname, k.GetMotherDir().GetPath()[len(fname)+1:].strip('/'),
+                 k.GetName(), k.GetCycle()) for k, fname in zip(keys, fnames)]
+        nworkers = min(nworkers, len(keys))
+        step = -(-len(keys) // nworkers)  # ceil
+        with ThreadPoolExecutor(max_workers=nworkers) as pool:
+            batches = pool.map(self._read_keys, [keys[i:i+step] for i in
+                                                 range(0, len(keys), step)])
+            return [obj for batch in batches for obj in batch]
+
+    @profiled('Rdir.read')
+    def read(self, path=None, robj_t=None, robj_p=None, metainfo=False,
+             nworkers=None):
         """Return list of object(s) in path.
 
         When metainfo is True, source filename is added as a property
-        (obj.file).  For documentation on other arguments, see
-        Rdir.ls(..)
+        (obj.file).  When nworkers is more than one, objects are read
+        concurrently by that many threads (default: Rdir.nworkers).
+        For documentation on other arguments, see Rdir.ls(..)
 
         """
-        objs = []
-        for k in self.ls(path, robj_t, robj_p):
-            objs.append(k.ReadObj())
-            if metainfo:
-                setattr(objs[-1], 'file', k.GetFile().GetName())
+        if nworkers is None:
+            nworkers = self.nworkers
+        keys = list(self.ls(path, robj_t, robj_p))
+        concurrent = nworkers > 1 and len(keys) > 1
+        if metainfo or concurrent:
+            fnames = [k.GetFile().GetName() for k in keys]
+        if concurrent:
+            objs = self._read_concurrent(keys, fnames, nworkers)
+        else:
+            objs = [k.ReadObj() for k in keys]
+        if metainfo:
+            for obj, fname in zip(objs, fnames):
+                setattr(obj, 'file', fname)
         return objs
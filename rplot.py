@@ -2,6 +2,7 @@
 """Plotting interface for ROOT objects"""
 
 from fixes import ROOT
+from rprof import profiled, count_clones
 
 # colours
 from ROOT import (kBlack, kGray, kMagenta, kRed, kOrange, kGreen,
@@ -15,6 +16,9 @@ from ROOT import (kDot, kPlus, kStar, kCircle, kMultiply,
                   kOpenTriangleUp, kOpenTriangleDown)
 
 
+from collections import namedtuple
+
+
 # helpers
 def get_screen_size():
     """Get screen size (linux only)"""
@@ -55,6 +59,122 @@ def isplottable(plottable):
     return isinstance(plottable, plottable_t)
 
 
+def plottable_digest(plottable):
+    """CRC32 of the contents (and errors) of a histogram, or graph"""
+    import numpy as np
+    from zlib import crc32
+    from utils import thncells, thn2array, rbuffer
+    if isinstance(plottable, ROOT.TH1):
+        bufs = [thncells(plottable), thncells(plottable, sumw2=True)]
+        if bufs[0] is None:     # e.g. profiles
+            bufs = [thn2array(plottable, err=True, overflow=True)]
+    elif isinstance(plottable, ROOT.TGraph):
+        getters = ['GetX', 'GetY']
+        if isinstance(plottable, ROOT.TGraphAsymmErrors):
+            getters += ['GetEXlow', 'GetEXhigh', 'GetEYlow', 'GetEYhigh']
+        elif isinstance(plottable, ROOT.TGraphErrors):
+            getters += ['GetEX', 'GetEY']
+        npoints = plottable.GetN()
+        bufs = [rbuffer(getattr(plottable, getter)(), npoints)
+                for getter in getters]
+    else:
+        return None
+    digest = 0
+    for buf in bufs:
+        if buf is not None:
+            digest = crc32(np.ascontiguousarray(buf).view(np.uint8), digest)
+    return digest
+
+
+_style_getters = (
+    ('TAttLine', ('GetLineColor', 'GetLineStyle', 'GetLineWidth')),
+    ('TAttFill', ('GetFillColor', 'GetFillStyle')),
+    ('TAttMarker', ('GetMarkerColor', 'GetMarkerStyle', 'GetMarkerSize'))
+)
+
+
+def plottable_sig(plottable, style=True):
+    """Cheap signature of a plottable, that changes with its contents
+    (see plottable_digest(..)), and its style (unless style is False)"""
+    from utils import root_addr
+    sig = (root_addr(plottable), plottable.GetName(), plottable.GetTitle())
+    if isinstance(plottable, ROOT.TH1):
+        sig += (plottable.GetEntries(), plottable.GetSumOfWeights(),
+                plottable.GetNcells(), plottable_digest(plottable))
+    elif isinstance(plottable, ROOT.TGraph):
+        sig += (plottable.GetN(), plottable_digest(plottable))
+    if style:
+        for att, getters in _style_getters:
+            if isinstance(plottable, getattr(ROOT, att)):
+                sig += tuple(getattr(plottable, getter)()
+                             for getter in getters)
+    return sig
+
+
+def plottable_yrange(plottable):
+    """Return (min, max, smallest positive) of a plottable's y-values.
+
+    The values include the error bars (bin contents ± errors for
+    histograms, y ± errors for graphs), and are read in one go.  For
+    1-D histograms only the bins in the visible x-range are used.  The
+    smallest positive value is None when there are none.
+
+    """
+    import numpy as np
+    from utils import thn2array, rbuffer
+    if isinstance(plottable, ROOT.TH1):
+        val, err = thn2array(plottable, err=True)
+        if plottable.GetDimension() == 1:
+            xaxis = plottable.GetXaxis()
+            visible = slice(xaxis.GetFirst() - 1, xaxis.GetLast())
+            val, err = val[visible], err[visible]
+        lows, highs = val - err, val + err
+    elif isinstance(plottable, ROOT.TGraph):
+        npoints = plottable.GetN()
+        val = rbuffer(plottable.GetY(), npoints)
+        if isinstance(plottable, ROOT.TGraphAsymmErrors):
+            lows = val - rbuffer(plottable.GetEYlow(), npoints)
+            highs = val + rbuffer(plottable.GetEYhigh(), npoints)
+        elif isinstance(plottable, ROOT.TGraphErrors):
+            err = rbuffer(plottable.GetEY(), npoints)
+            lows, highs = val - err, val + err
+        else:
+            lows, highs = val, val
+    else:
+        return (plottable.GetMinimum(), plottable.GetMaximum(), None)
+    if not val.size:
+        return (0., 0., None)
+    # bins with large errors still have positive contents
+    positive = np.concatenate((lows[lows > 0], val[val > 0]))
+    return (lows.min(), highs.max(),
+            positive.min() if positive.size else None)
+
+
+def same_binning(hists):
+    """Do histograms have the same axes (limits, and bin edges)?"""
+    import numpy as np
+    from utils import taxisbins
+
+    def binning(hist):
+        return [(axis.GetNbins(), axis.GetXmin(), axis.GetXmax(), axis)
+                for axis in (hist.GetXaxis(), hist.GetYaxis(),
+                             hist.GetZaxis())]
+
+    ref = binning(hists[0])
+    for hist in hists[1:]:
+        if hist.GetDimension() != hists[0].GetDimension():
+            return False
+        for (nbins, xmin, xmax, axis), (rnbins, rxmin, rxmax, raxis) in \
+                zip(binning(hist), ref):
+            if nbins != rnbins or not np.allclose([xmin, xmax],
+                                                  [rxmin, rxmax]):
+                return False
+            if (axis.IsVariableBinSize() or raxis.IsVariableBinSize()) and \
+               not np.allclose(taxisbins(axis)[1], taxisbins(raxis)[1]):
+                return False
+    return True
+
+
 def arrange(plottables, sep, reverse=False, predicate=None):
     """Rearrange plottables in nested structure understood by Rplot.
 
@@ -101,6 +221,7 @@ class Rplot(object):
 
     grid = (1, 1)
     size = (400, 400)
+    pad_size = (400, 300)       # default in batch mode
     alpha = 0.05
     plots = []
     canvas = None
@@ -109,12 +230,28 @@ class Rplot(object):
     stack = False
     shrink2fit = True
     legend = []
+    incremental = False
+    pad_sigs = {}
+    yranges_size = 1024
 
     def __init__(self, xgrid=1, ygrid=1, width=None, height=None):
-        if ROOT.gROOT.IsBatch() and not (width and height):
-            raise ValueError('Width & height compulsory in batch mode!')
+        """Plotter for a grid of pads.
+
+        When neither width nor height is given, the canvas size is
+        chosen to fit the screen, or from pad_size in batch mode
+        (which never queries the display).
+
+        """
+        if ROOT.gROOT.IsBatch() and not (width or height):
+            width, height = (self.pad_size[0] * xgrid,
+                             self.pad_size[1] * ygrid)
         self.grid = (xgrid, ygrid)
         self.nplots = xgrid * ygrid
+        self.plots = []
+        self.pad_sigs = {}
+        self.stacked = {}
+        self.stack_buffers = {}
+        self.yranges = {}
         self.size = get_optimal_size(xgrid, ygrid, width, height)
         ROOT.gStyle.SetOptTitle(0)
 
@@ -129,16 +266,88 @@ class Rplot(object):
         self.legend = [ROOT.TLegend(legend) for i in range(self.nplots)]
         self.leg_opt = option
 
-    def get_stack(self, plots):
-        plots_s = [[] for i in range(len(plots))]
-        for i, plot in enumerate(plots):
+    @staticmethod
+    def _clone(plottable):
+        """Clone plottable, w/o adding it to the current directory"""
+        clone = plottable.Clone('{}_s'.format(plottable.GetName()))
+        count_clones()
+        if isinstance(clone, ROOT.TH1):
+            clone.SetDirectory(0)
+        return clone
+
+    def stack_plot(self, plot, pad=None):
+        """Return stacked copies of plottables on a pad (reversed).
+
+        Histograms are stacked in one vectorised pass over their
+        contents (and sum of weights squared), and the stacked copies
+        of a pad are reused when it is stacked again, see
+        clear_stack(..).  Other plottables (e.g. profiles) are cloned,
+        and added one after the other.  Raises ValueError for
+        histograms with different binning (see same_binning(..)).
+
+        """
+        if not plot or isplottable(plot):
+            return plot
+        import numpy as np
+        from utils import thncells
+        hists = [pl for pl in plot if isinstance(pl, ROOT.TH1)]
+        if len(hists) > 1 and not same_binning(hists):
+            raise ValueError('Cannot stack histograms with different '
+                             'binning: {}'.format(', '.join(
+                                 hist.GetName() for hist in hists)))
+        cells = [thncells(pl) if isinstance(pl, ROOT.TH1) else None
+                 for pl in plot]
+        if any(c is None for c in cells):
+            plot_s = []
             for j, plottable in enumerate(plot):
-                plots_s[i].append(plottable.Clone('{}_s'.format(
-                    plottable.GetName())))
+                plot_s.append(self._clone(plottable))
                 if j > 0:
-                    plots_s[i][-1].Add(plots_s[i][-2])
-            plots_s[i].reverse()
-        return plots_s
+                    plot_s[-1].Add(plot_s[-2])
+            plot_s.reverse()
+            return plot_s
+
+        stacked = self.stacked.get(pad, [])
+        if len(stacked) != len(plot) or \
+           any(st.ClassName() != pl.ClassName() or
+               st.GetNcells() != pl.GetNcells()
+               for st, pl in zip(stacked, plot)):
+            stacked = [self._clone(pl) for pl in plot]
+            if pad is not None:
+                self.stacked[pad] = stacked
+        # contents, and sum of weights squared
+        shape = (2, len(plot), cells[0].size)
+        buf = self.stack_buffers.get(pad)
+        if buf is None or buf.shape != shape:
+            buf = np.empty(shape)
+            if pad is not None:
+                self.stack_buffers[pad] = buf
+        for k, plottable in enumerate(plot):
+            buf[0, k] = cells[k]
+            sumw2 = thncells(plottable, sumw2=True)
+            buf[1, k] = np.abs(cells[k]) if sumw2 is None else sumw2
+        np.cumsum(buf, axis=1, out=buf)
+        entries = np.cumsum([pl.GetEntries() for pl in plot])
+        for k, (plottable, st) in enumerate(zip(plot, stacked)):
+            st.SetTitle(plottable.GetTitle())
+            if not st.GetSumw2N():
+                st.Sumw2()
+            st.SetContent(buf[0, k])
+            st.GetSumw2().Set(shape[2], buf[1, k])
+            st.ResetStats()
+            st.SetEntries(entries[k])
+        return stacked[::-1]
+
+    def get_stack(self, plots):
+        return [self.stack_plot(plot, i) for i, plot in enumerate(plots)]
+
+    def clear_stack(self, pads=None):
+        """Delete stacked copies of pads (list of indices, default: all)"""
+        for i in list(self.stacked) if pads is None else pads:
+            self.stacked.pop(i, None)
+            self.stack_buffers.pop(i, None)
+            self.pad_sigs.pop(i, None)
+            if self.stack and i < len(self.plots):
+                self.plots[i] = None
 
     def set_style(self, plottable, num):
         if isinstance(plottable, ROOT.TAttFill):
@@ -153,11 +362,45 @@ class Rplot(object):
             plottable.SetMarkerStyle(self.markers[num])
             plottable.SetMarkerColor(self.line_colours[num])
 
-    def get_viewport(self, plot):
-        ymin, ymax = 0, 0
+    def get_viewport(self, plot, logy=None, normalised=False):
+        """Return y-range that fits all plottables (with error bars).
+
+        With log scale (default: from the current pad), the lower
+        edge is set from the smallest positive value.  The y-ranges
+        of plottables are cached, see plottable_yrange(..).
+
+        """
+        if logy is None:
+            logy = bool(ROOT.gPad and ROOT.gPad.GetLogy())
+        ranges = []
         for plottable in plot:
-            ymin = min(ymin, plottable.GetMinimum())
-            ymax = max(ymax, plottable.GetMaximum())
+            # contents, and the visible x-range (not the style)
+            sig = plottable_sig(plottable, style=False)
+            if isinstance(plottable, ROOT.TH1):
+                xaxis = plottable.GetXaxis()
+                sig += (xaxis.GetFirst(), xaxis.GetLast())
+            yrange = self.yranges.get(sig)
+            if yrange is None:
+                if len(self.yranges) >= self.yranges_size:
+                    self.yranges.clear()
+                yrange = self.yranges[sig] = plottable_yrange(plottable)
+            if normalised and isinstance(plottable, ROOT.TH1) and \
+               plottable.GetSumOfWeights() > 0:
+                norm = 1.0 / plottable.GetSumOfWeights()
+                yrange = (yrange[0] * norm, yrange[1] * norm,
+                          yrange[2] and yrange[2] * norm)
+            ranges.append(yrange)
+        if logy:
+            from math import log10
+            positive = [r[2] for r in ranges if r[2]]
+            if not positive:
+                return (0.1, 1.0)
+            ymin = min(positive)
+            ymax = max(max(r[1] for r in ranges), ymin)
+            margin = 0.03 * max(log10(ymax / ymin), 1)
+            return (ymin * 10**-margin, ymax * 10**margin)
+        ymin = min([0] + [r[0] for r in ranges])
+        ymax = max([0] + [r[1] for r in ranges])
         if ymin < 0:
             ymin += 0.03*ymin
         if ymax > 0:
@@ -172,11 +415,8 @@ class Rplot(object):
             print('# plottables ≠ # options!')
             return
         if self.shrink2fit:
-            yrange = self.get_viewport(plot)
+            yrange = self.get_viewport(plot, normalised=normalised)
         for i, plottable in enumerate(plot):
-            if self.shrink2fit:
-                plottable.SetMinimum(yrange[0])
-                plottable.SetMaximum(yrange[1])
             if self.style:
                 self.set_style(plottable, i)
             if i > 0:
@@ -184,13 +424,74 @@ class Rplot(object):
             else:
                 opts = drawopts[i]
             if normalised:
-                plottable.DrawNormalized(opts)
+                # scales the range too, set it on the normalised copy
+                drawn = plottable.DrawNormalized(opts)
             else:
+                drawn = plottable
                 plottable.Draw(opts)
+            if self.shrink2fit and drawn:
+                drawn.SetMinimum(yrange[0])
+                drawn.SetMaximum(yrange[1])
             if legend:
                 legend.AddEntry(plottable, plottable.GetTitle(), self.leg_opt)
 
+    def pad_signature(self, plot, drawopts, normalised):
+        """Signature of what is drawn on a pad, see incremental mode"""
+        if not plot:
+            return None
+        if isplottable(plot):
+            plot = [plot]
+        return (tuple(plottable_sig(pl) for pl in filter(None, plot)),
+                str(drawopts), normalised, self.stack, self.style,
+                self.shrink2fit, bool(self.legend))
+
+    def touch(self, pads=None):
+        """Mark pads (list of indices, default: all) to be redrawn"""
+        if pads is None:
+            self.pad_sigs = {}
+        for i in pads or []:
+            self.pad_sigs.pop(i, None)
+
+    def draw_pad(self, i, plot, drawopts, normalised=False):
+        """Draw plot (plottable, or list of plottables) on pad i"""
+        pad = self.canvas.cd(i+1)
+        if not plot:
+            pad.Clear()
+            return
+        if self.legend:
+            legend = self.legend[i]
+            legend.Clear()
+        else:
+            legend = None
+        if isplottable(plot):
+            if self.style:
+                self.set_style(plot, 0)
+            if normalised:
+                plot.DrawNormalized(drawopts)
+            else:
+                plot.Draw(drawopts)
+            if legend:  # FIXME: customisable legend type
+                legend.AddEntry(plot, plot.GetTitle(), self.leg_opt)
+        else:
+            self.draw_same(plot, drawopts, normalised, legend)
+        if legend:
+            legend.Draw()
+
+    @profiled('Rplot.draw_hist')
     def draw_hist(self, plots, drawopts, normalised=False):
+        """Draw plots on the grid of pads.
+
+        plots      -- list with a plot for every pad, a plot is a
+                      plottable, or a list of plottables to overlay
+        drawopts   -- draw option for all, or a list for every plot
+        normalised -- draw normalised plots
+
+        In incremental mode, only pads whose plottables (see
+        plottable_sig(..)) or options changed since the last call are
+        redrawn; stacked copies and legends of other pads are kept.
+        Use touch(..) to force redrawing pads.
+
+        """
         diff = len(plots) - self.nplots
         if diff > 0:
             print('# plots ({}) > # pads ({})!'
@@ -201,43 +502,170 @@ class Rplot(object):
             plots += [None] * (-diff)
         if not self.canvas:
             self.prep_canvas()
+        if isinstance(drawopts, str):
+            drawopts = [drawopts] * len(plots)
+        if len(plots) != len(drawopts):
+            print('# plots ({}) ≠ # options ({})!'
+                  .format(len(plots), len(drawopts)))
+            return
+        if self.incremental:
+            sigs = [self.pad_signature(plot, drawopts[i], normalised)
+                    for i, plot in enumerate(plots)]
+            dirty = [i for i, sig in enumerate(sigs)
+                     if i not in self.pad_sigs or self.pad_sigs[i] != sig]
+            self.pad_sigs = dict(enumerate(sigs))
+        else:
+            dirty = range(len(plots))
         if self.stack:
             # necessary, goes out of scope otherwise
-            self.plots = self.get_stack(plots)
+            if self.incremental and len(self.plots) == len(plots):
+                stacked = list(self.plots)
+            else:
+                stacked = [None] * len(plots)
+            for i in dirty:
+                stacked[i] = self.stack_plot(plots[i], i)
+            self.plots = stacked
         else:
             # only for consistency with the above
             self.plots = plots
-        if isinstance(drawopts, str):
-            drawopts = [drawopts] * len(self.plots)
-        if len(self.plots) != len(drawopts):
-            print('# plots ({}) ≠ # options ({})!'
-                  .format(len(self.plots), len(drawopts)))
-            return
-        for i, plot in enumerate(self.plots):
-            pad = self.canvas.cd(i+1)
-            if not plot:
-                pad.Clear()
-                continue
-            if self.legend:
-                legend = self.legend[i]
-                legend.Clear()
-            else:
-                legend = None
-            if isplottable(plot):
-                if self.style:
-                    self.set_style(plot, 0)
-                if normalised:
-                    plot.DrawNormalized(drawopts[i])
-                else:
-                    plot.Draw(drawopts[i])
-                if legend:  # FIXME: customisable legend type
-                    legend.AddEntry(plot, plot.GetTitle(), self.leg_opt)
-            else:
-                self.draw_same(plot, drawopts[i], normalised, legend)
-            if legend:
-                legend.Draw()
+        for i in dirty:
+            self.draw_pad(i, self.plots[i], drawopts[i], normalised)
+            if self.incremental:  # drawing may set the style
+                self.pad_sigs[i] = self.pad_signature(plots[i], drawopts[i],
+                                                      normalised)
         return self.canvas
 
     def draw_graph(self, *args, **kwargs):
         """Same as draw_hist(..)."""
         return self.draw_hist(*args, **kwargs)
+
+    def export(self, pages, drawopts, filename, normalised=False):
+        """Draw pages of plots on one canvas, and save them to file(s).
+
+        pages      -- list of plot groups, every group is drawn as a
+                      page with draw_hist(..)
+        drawopts   -- draw options for every page (see draw_hist(..))
+        filename   -- output file, the format follows the extension
+                      (png, pdf, svg, ...).  With a `{}' placeholder
+                      (e.g. 'plots_{:03d}.png'), every page is saved to
+                      its own file, otherwise all pages are saved to
+                      one multi-page file (PDF or PostScript only).
+        normalised -- draw normalised plots
+
+        The canvas is reused for all pages.  Returns the list of files
+        written.
+
+        """
+        perpage = filename.find('{') >= 0
+        if not perpage and len(pages) > 1 and \
+           not filename.endswith(('.pdf', '.ps')):
+            raise ValueError('Multi-page output needs PDF/PS, '
+                             'or a `{{}}\' in file name: {}'.format(filename))
+        if not self.canvas:
+            self.prep_canvas()
+        files = []
+        for i, plots in enumerate(pages):
+            # draw_hist(..) pads the list with blanks
+            self.draw_hist(list(plots), drawopts, normalised)
+            self.canvas.Update()
+            if perpage:
+                files.append(filename.format(i))
+                self.canvas.Print(files[-1])
+            elif len(pages) == 1:
+                self.canvas.Print(filename)
+            elif i == 0:        # open multi-page file
+                self.canvas.Print('{}('.format(filename))
+            elif i == len(pages) - 1:  # close multi-page file
+                self.canvas.Print('{})'.format(filename))
+            else:
+                self.canvas.Print(filename)
+        return files if perpage else [filename]
+
+
+# rendering farm
+class Rjob(object):
+    """Rendering job, see render(..).
+
+    pages      -- list of plot groups (as in Rplot.export(..)), where
+                  every object is either a ROOT object (sent to the
+                  worker with pickle), or a path to one in a ROOT
+                  file, e.g. 'file.root:/dir/hist' (see rdir.pathspec)
+    drawopts   -- draw options (see Rplot.draw_hist(..))
+    output     -- output file name (see Rplot.export(..))
+    grid       -- pad grid, (xgrid, ygrid)
+    size       -- canvas size, (width, height), or None for default
+    normalised -- draw normalised plots
+    stack      -- stack plottables
+
+    """
+
+    def __init__(self, pages, drawopts, output, grid=(1, 1), size=None,
+                 normalised=False, stack=False):
+        self.pages = pages
+        self.drawopts = drawopts
+        self.output = output
+        self.grid = grid
+        self.size = size
+        self.normalised = normalised
+        self.stack = stack
+
+
+Rresult = namedtuple('Rresult', 'output files walltime cputime error')
+Rresult.__doc__ = """Result of a rendering job: files written, timing, and
+error message (None on success)"""
+
+
+def _render_init():
+    ROOT.gROOT.SetBatch(True)
+    ROOT.gErrorIgnoreLevel = ROOT.kWarning
+
+
+def _render(job):
+    """Render job (in a worker process), return Rresult"""
+    import time
+    from rdir import Rdir
+    wall, cpu = time.time(), time.process_time()
+    rdir = Rdir([])
+
+    def _resolve(obj):
+        if isinstance(obj, str):
+            objs = rdir.read(obj)
+            if len(objs) != 1:
+                raise ValueError('{}: not a ROOT object'.format(obj))
+            return objs[0]
+        elif isinstance(obj, (list, tuple)):
+            return [_resolve(el) for el in obj]
+        else:
+            return obj
+
+    try:
+        pages = _resolve(job.pages)
+        plotter = Rplot(job.grid[0], job.grid[1], *(job.size or (None, None)))
+        plotter.stack = job.stack
+        files = plotter.export(pages, job.drawopts, job.output,
+                               job.normalised)
+        error = None
+    except Exception as err:
+        files, error = [], '{}: {}'.format(type(err).__name__, err)
+    return Rresult(job.output, files, time.time() - wall,
+                   time.process_time() - cpu, error)
+
+
+def render(jobs, nproc=None):
+    """Render independent jobs with a pool of worker processes.
+
+    jobs  -- list of Rjob
+    nproc -- number of worker processes (default: number of CPUs)
+
+    Every worker is a fresh process with its own batch mode ROOT, so
+    ROOT objects in jobs have to be picklable.  Returns a list of
+    Rresult, in the order of jobs.  Errors in a job are reported in
+    its Rresult; if a worker dies (e.g. ROOT crashes), BrokenProcessPool
+    is raised instead.
+
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(nproc, multiprocessing.get_context('spawn'),
+                             _render_init) as pool:
+        return list(pool.map(_render, jobs))
@@ -38,6 +38,8 @@ class rshell(cmd.Cmd):
     ls_parser.add_argument('paths', nargs='*', help='Object names.')
 
     pwd = gROOT
+    pwdpath = None              # as a pathspec, None for gROOT
+    oldpwd = None               # a path, its file may have been closed
     prompt = '{}> '.format(pwd.GetName())
 
     objs = {}
@@ -59,14 +61,21 @@ class rshell(cmd.Cmd):
         return '{:.1f}{}'.format(Bytes, unit)
 
     def add_files(self, files):
-        self.rdir_helper = Rdir(files)
+        self.rdir_helper = Rdir(files, index=True, prefetch=True)
+        self.rdir_helper.nworkers = 4
+
+    def report_errors(self):
+        """Report files that failed to open in the background"""
+        for fname, err in self.rdir_helper.poll():
+            print('Error: {}'.format(err))
 
     def completion_helper(self, text, line, begidx, endidx, comp_type=None):
         if line.rfind(':') > 0:
             pathstr = line.split()[-1]
         else:
             pathstr = text
-        self.comp_f = [f.GetName() + ':' for f in self.rdir_helper.files]
+        self.rdir_helper.poll()
+        self.comp_f = [fname + ':' for fname in self.rdir_helper.filenames]
         if self.pwd == gROOT and pathstr.find(':') < 0:
             completions = self.comp_f
         else:
@@ -85,11 +94,14 @@ class rshell(cmd.Cmd):
             return filter(lambda i: str.startswith(i, text), completions)
 
     def precmd(self, line):
+        self.report_errors()
         return cmd.Cmd.precmd(self, line)
 
     def postcmd(self, stop, line):
-        self.oldpwd = self.pwd.GetDirectory('')
         self.pwd = gDirectory.GetDirectory('')
+        pwdpath = None if self.pwd == gROOT else self.pwd.GetPath()
+        if pwdpath != self.pwdpath:
+            self.oldpwd, self.pwdpath = self.pwdpath, pwdpath
         dirn = self.pwd.GetName()
         if len(dirn) > 20:
             dirn = '{}..{}'.format(dirn[0:9], dirn[-9:])
@@ -184,9 +196,12 @@ class rshell(cmd.Cmd):
                     print(str(err).format('ls', path))
         else:                     # no args
             if gROOT == self.pwd:
-                # can't access files trivially when in root
-                for f in gROOT.GetListOfFiles():
-                    self.print_key(f, self.get_ls_fmt(opts.showtype))
+                # all files, including those closed by the pool; gROOT
+                # also lists extra handles used by workers
+                fmt = self.get_ls_fmt(opts.showtype)
+                for fname in self.rdir_helper.filenames:
+                    print(fmt.format(cls='TFile', nm=fname, m=':', fs='-',
+                                     us='-'))
             else:               # in a file
                 try:
                     self.ls_objs(self.rdir_helper.ls(), opts.showtype)
@@ -216,15 +231,16 @@ class rshell(cmd.Cmd):
 
     def do_cd(self, args=''):
         """Change directory to specified directory.  See also: pathspec."""
-        if args.strip() == '-':
-            success = self.oldpwd.cd()
-        else:
-            success = self.pwd.cd(args)
-        if not success:
+        path = args.strip()
+        if path == '-':
+            path = self.oldpwd or ''
+        if not path:
+            gROOT.cd()
+            return
+        # (re)opens files closed by the pool
+        rdir = self.rdir_helper.get_dir(path)
+        if not (rdir and rdir.cd()):
             print('cd: {}: No such file or directory'.format(args))
-        else:
-            if not args.strip():
-                gROOT.cd()
 
     def complete_cd(self, text, line, begidx, endidx):
         return self.completion_helper(text, line, begidx, endidx,
@@ -0,0 +1,217 @@
+# coding=utf-8
+"""Opt-in profiling of the read, select, and draw pipeline
+
+Stages of the pipeline (Rdir.read, Tselect.fill_hists,
+Tsplice.make_splice, Rplot.draw_hist, thn2array, ...) are recorded
+only while a profiler is active:
+
+    >>> with Rprof() as prof:
+    ...     hists = Tselect(tree).fill_hists()
+    ...     canvas.draw_hist(hists, 'hist')
+    >>> print(prof.summary())
+    >>> prof.dump_trace('trace.json')  # chrome://tracing, Perfetto
+    >>> prof.dump_collapsed('stacks.txt')  # flamegraph.pl
+
+W/o an active profiler a stage costs one list lookup.
+
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    _walltime = time.perf_counter
+    _cputime = time.process_time
+except AttributeError:          # Python 2
+    _walltime = time.time
+    _cputime = time.clock
+
+_profilers = []                 # active profilers
+_state = threading.local()      # stack of stages per thread
+
+
+def _frames():
+    """Stages entered, but not exited, by the current thread"""
+    if not hasattr(_state, 'frames'):
+        _state.frames = []
+    return _state.frames
+
+
+def _bytes_read():
+    """Bytes read from all ROOT files so far"""
+    from fixes import ROOT
+    return ROOT.TFile.GetFileBytesRead()
+
+
+class stage(object):
+    """Context manager to record a stage with the active profilers.
+
+       Stages nest; times, bytes read, and clones of a stage include
+       those of its sub-stages.  Bytes read and CPU time are counted
+       for the whole process, so they also include other threads.
+
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.profs = list(_profilers)
+        if not self.profs:
+            return self
+        frames = _frames()
+        self.path = (frames[-1].path if frames else ()) + (self.name,)
+        self.children = 0.      # wall time in sub-stages
+        self.clones = 0
+        frames.append(self)
+        self.start = (_walltime(), _cputime(), _bytes_read())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.profs:
+            return
+        end = (_walltime(), _cputime(), _bytes_read())
+        wall = end[0] - self.start[0]
+        frames = _frames()
+        frames.pop()
+        if frames:
+            frames[-1].children += wall
+            frames[-1].clones += self.clones
+        for prof in self.profs:
+            prof._record(self, wall, end[1] - self.start[1],
+                         end[2] - self.start[2])
+
+
+def profiled(name):
+    """Decorator to record every call of a function as a stage"""
+    def decorator(fn):
+        from functools import wraps
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _profilers:
+                return fn(*args, **kwargs)
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_clones(n=1):
+    """Count ROOT objects cloned in the current stage"""
+    if _profilers:
+        frames = _frames()
+        if frames:
+            frames[-1].clones += n
+
+
+class Rprof(object):
+    """Profiler recording wall/CPU time, bytes read, objects cloned,
+       and calls for every stage (see stage, and profiled(..)).
+
+       Use as a context manager; profilers may be nested, every active
+       profiler records all stages.
+
+    """
+
+    def __init__(self):
+        self.stats = OrderedDict()  # per stage name
+        self.events = []            # every call, for traces
+        self.origin = _walltime()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        _profilers.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _profilers.remove(self)
+
+    def _record(self, frame, wall, cpu, nbytes):
+        with self._lock:
+            stat = self.stats.setdefault(frame.name, OrderedDict(
+                [('calls', 0), ('wall', 0.), ('cpu', 0.),
+                 ('bytesread', 0), ('clones', 0)]))
+            stat['calls'] += 1
+            stat['wall'] += wall
+            stat['cpu'] += cpu
+            stat['bytesread'] += nbytes
+            stat['clones'] += frame.clones
+            self.events.append((frame.path, threading.current_thread().ident,
+                                frame.start[0] - self.origin, wall,
+                                wall - frame.children, cpu, nbytes,
+                                frame.clones))
+
+    def reset(self):
+        """Forget everything recorded so far"""
+        with self._lock:
+            self.stats.clear()
+            del self.events[:]
+            self.origin = _walltime()
+
+    def summary(self):
+        """Return table of stages as a string"""
+        fmt = '{:<24} {:>8} {:>10} {:>10} {:>12} {:>8}'
+        lines = [fmt.format('stage', 'calls', 'wall [s]', 'cpu [s]',
+                            'bytes read', 'clones')]
+        for name, stat in self.stats.items():
+            lines.append(fmt.format(
+                name, stat['calls'], '{:.4f}'.format(stat['wall']),
+                '{:.4f}'.format(stat['cpu']), stat['bytesread'],
+                stat['clones']))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        """Return stages and calls as JSON serialisable dictionary"""
+        keys = ('stack', 'thread', 'start', 'wall', 'self', 'cpu',
+                'bytesread', 'clones')
+        with self._lock:
+            events = [dict(zip(keys, ev)) for ev in self.events]
+            for ev in events:
+                ev['stack'] = list(ev['stack'])
+            return {'stages': OrderedDict((name, dict(stat)) for name, stat
+                                          in self.stats.items()),
+                    'calls': events}
+
+    def dump_json(self, filename):
+        """Write stages and calls as JSON"""
+        import json
+        with open(filename, 'w') as out:
+            json.dump(self.to_dict(), out, indent=2)
+
+    def trace(self):
+        """Return calls in the Chrome trace event format"""
+        import os
+        pid = os.getpid()
+        with self._lock:
+            events = [{'name': path[-1], 'cat': 'rplot', 'ph': 'X',
+                       'ts': start * 1e6, 'dur': wall * 1e6,
+                       'pid': pid, 'tid': tid,
+                       'args': {'cpu': cpu, 'bytesread': nbytes,
+                                'clones': clones}}
+                      for path, tid, start, wall, own, cpu, nbytes, clones
+                      in self.events]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump_trace(self, filename):
+        """Write calls as a Chrome trace (chrome://tracing, Perfetto)"""
+        import json
+        with open(filename, 'w') as out:
+            json.dump(self.trace(), out)
+
+    def collapsed(self):
+        """Return collapsed stacks (`a;b;c self-time'), with self time in
+           microseconds, as expected by flamegraph.pl and speedscope"""
+        stacks = OrderedDict()
+        with self._lock:
+            for ev in self.events:
+                key = ';'.join(ev[0])
+                stacks[key] = stacks.get(key, 0.) + ev[4]
+        return ['{} {}'.format(key, int(round(own * 1e6)))
+                for key, own in stacks.items()]
+
+    def dump_collapsed(self, filename):
+        """Write collapsed stacks, see collapsed(..)"""
+        with open(filename, 'w') as out:
+            out.write('\n'.join(self.collapsed()) + '\n')
@@ -1,6 +1,8 @@
 import unittest
+import os
 from fixes import ROOT
-from r2mpl import th12errorbar, th12hist
+from r2mpl import (th12errorbar, th12hist, th22pcolormesh, root2arrays,
+                   pad_arrays, Mplot)
 import numpy as np
 
 
@@ -28,3 +30,101 @@ class test_r2mpl(unittest.TestCase):
         c, b = th12hist(self.hist, edges=True)
         self.assertEqual(np.shape(c), (self.nbins,))
         self.assertEqual(np.shape(b), (self.nbins+1,))
+
+    def test_th22pcolormesh(self):
+        hist = ROOT.TH2F('hist2', '', 10, -3, 3, 5, -3, 3)
+        hist.Fill(0, 0)
+        x, y, c = th22pcolormesh(hist)
+        self.assertEqual(np.shape(x), (11,))
+        self.assertEqual(np.shape(y), (6,))
+        self.assertEqual(np.shape(c), (5, 10))
+        self.assertEqual(c.count(), 1)
+        self.assertEqual(c[2, 5], 1)     # [y][x]
+
+    def test_th3(self):
+        hist = ROOT.TH3D('hist3', '', 4, 0, 4, 3, 0, 3, 2, 0, 2)
+        hist.Fill(1.5, 2.5, 0.5, 2)
+        edges, content, error = root2arrays(hist)
+        self.assertEqual([np.size(e) for e in edges], [5, 4, 3])
+        self.assertEqual(np.shape(content), (2, 3, 4))
+        self.assertEqual(content[0, 2, 1], 2)
+        hist.Fill(0.5, 0.5, 0.5)     # contents are a view
+        self.assertEqual(content[0, 0, 0], 1)
+        self.assertAlmostEqual(error[0, 2, 1], 2)
+
+    def test_profile(self):
+        prof = ROOT.TProfile('prof', '', 4, 0, 4)
+        prof.Fill(0.5, 1)
+        prof.Fill(0.5, 3)
+        edges, content, error = root2arrays(prof)
+        self.assertEqual(np.shape(content), (4,))
+        self.assertAlmostEqual(content[0], 2)
+        self.assertAlmostEqual(error[0], prof.GetBinError(1))
+
+    def test_graph(self):
+        graph = ROOT.TGraphAsymmErrors(3)
+        for i in range(3):
+            graph.SetPoint(i, i, i*i)
+            graph.SetPointError(i, 0.1, 0.2, 0.3, 0.4)
+        x, y, xerr, yerr = root2arrays(graph)
+        self.assertTrue(np.allclose(y, [0, 1, 4]))
+        self.assertTrue(np.allclose(yerr, [[0.3]*3, [0.4]*3]))
+        x, y, xerr, yerr = root2arrays(ROOT.TGraph(3))
+        self.assertIsNone(yerr)
+
+
+class test_Mplot(unittest.TestCase):
+    def setUp(self):
+        self.hists = [ROOT.TH1F('hist{}'.format(i), '', 20, -3, 3)
+                      for i in range(4)]
+        for hist in self.hists:
+            hist.FillRandom('gaus', 1000)
+        self.pngfile = '/tmp/test_mplot.png'
+
+    def tearDown(self):
+        del self.hists
+        if os.path.exists(self.pngfile):
+            os.remove(self.pngfile)
+
+    def test_draw(self):
+        plotter = Mplot(2, 1)
+        plotter.stack = True
+        fig = plotter.draw_hist([self.hists[:2], self.hists[2:]], 'hist')
+        self.assertEqual(len(fig.axes), 2)
+        self.assertEqual(len(fig.axes[0].patches), 2)
+        top = max(p.get_data().values.sum() for p in fig.axes[0].patches)
+        self.assertAlmostEqual(top, sum(h.GetSumOfWeights()
+                                        for h in self.hists[:2]), places=3)
+
+    def test_normalised_stack(self):
+        from ROOT import TFrame
+        from rplot import Rplot
+        from utils import thn2array
+        self.hists[1].Scale(3)
+        plotter = Rplot(1, 1, 400, 400)
+        plotter.stack = True
+        canvas = plotter.draw_hist([self.hists[:2]], 'hist', normalised=True)
+        drawn = [pl for pl in canvas.cd(1).GetListOfPrimitives()
+                 if not isinstance(pl, TFrame)]
+        drawn.reverse()         # largest first in Rplot
+        res = pad_arrays(self.hists[:2], normalised=True, stack=True)
+        self.assertEqual(len(drawn), len(res))
+        for hist, (edges, content, error) in zip(drawn, res):
+            self.assertTrue(np.allclose(thn2array(hist), content,
+                                        rtol=1e-5))
+        self.assertAlmostEqual(res[-1][1].sum(), 1, places=5)
+
+    def test_draw2d(self):
+        hist = ROOT.TH2F('hist2d', '', 10, -3, 3, 5, -3, 3)
+        hist.Fill(0, 0)
+        plotter = Mplot(1, 1)
+        fig = plotter.draw_hist([hist], 'colz')
+        mesh = fig.axes[0].collections[0]
+        self.assertEqual(np.size(mesh.get_array()), 50)
+
+    def test_export(self):
+        plotter = Mplot(2, 1)
+        files = plotter.export([[self.hists[0], self.hists[1]]], 'e1',
+                               self.pngfile)
+        self.assertEqual(files, [self.pngfile])
+        self.assertTrue(os.path.exists(self.pngfile))
@@ -2,7 +2,7 @@ import unittest
 import os
 from fixes import ROOT
 from ROOT import gDirectory, TFile
-from rdir import pathspec, savepwd, Rdir
+from rdir import pathspec, savepwd, Rdir, Rfilepool
 
 
 class test_pathspec(unittest.TestCase):
@@ -34,6 +34,24 @@ class test_pathspec(unittest.TestCase):
         self.assertLess(self.rpath_no_slash.rpath.find('/', -1), 0)
         self.assertRaises(ValueError, pathspec, 'foo.root:../bar/baz')
 
+    def test_url(self):
+        url = pathspec('root://host:1094//eos/foo.root:/bar/baz')
+        self.assertEqual(url.scheme, 'root')
+        self.assertEqual(url.rfile, 'root://host:1094//eos/foo.root')
+        self.assertEqual(url.rpath, '/bar/baz')
+        self.assertTrue(pathspec('file:///tmp/foo').norpath)
+
+    def test_interned(self):
+        self.assertIs(pathspec('foo.root:/bar/baz'), self.full_path)
+        self.assertIs(pathspec(self.full_path), self.full_path)
+        self.assertEqual(self.full_path.parent, pathspec('foo.root:/bar'))
+        self.assertNotEqual(self.abs_rpath, self.rel_rpath1)
+        self.assertEqual(len(set([self.only_rfile1, pathspec('foo.root')])),
+                         1)
+        self.assertEqual(repr(self.only_rfile1), "pathspec('foo.root')")
+        self.assertRaises(AttributeError, setattr, self.full_path,
+                          'rfile', 'bar.root')
+
 
 class test_savepwd(unittest.TestCase):
     def setUp(self):
@@ -206,3 +224,83 @@ class test_Rdir(unittest.TestCase):
         keys_r = [k for k in rdir_helper.files[0].GetListOfKeys()
                   if k.GetName().find('hist') >= 0]
         self.assertListEqual(keys_r, keys_t)
+
+    def test_index(self):
+        rdir_helper = Rdir(self.fnames)
+        rdir_index = Rdir(self.fnames, index=True)
+        for path in ['/tmp/test_Rdir0.root', '/tmp/test_Rdir1.root:/dirc',
+                     '/tmp/test_Rdir0.root:/dira/hista']:
+            self.assertListEqual(rdir_helper.ls_names(path),
+                                 rdir_index.ls_names(path))
+        info = rdir_index.index['/tmp/test_Rdir0.root:/dira/hista']
+        self.assertEqual(info.classname, 'TH1C')
+        self.assertEqual(rdir_index.key(info).GetNbytes(), info.nbytes)
+        self.assertNotIn('/tmp/test_Rdir0.root:/dirb/histb', rdir_index.index)
+        objs = rdir_index.read('/tmp/test_Rdir1.root:/dirb', metainfo=True)
+        self.assertEqual(objs[0].file, '/tmp/test_Rdir1.root')
+        keys = rdir_index.ls('/tmp/test_Rdir0.root:', robj_t=ROOT.TDirectoryFile)
+        self.assertListEqual(['dira', 'dirb', 'dirc'],
+                             sorted(k.GetName() for k in keys))
+
+    def test_read_concurrent(self):
+        rdir_helper = Rdir(self.fnames)
+        objs_r = rdir_helper.read('/tmp/test_Rdir1.root')
+        objs_t = rdir_helper.read('/tmp/test_Rdir1.root', metainfo=True,
+                                  nworkers=3)
+        self.assertListEqual([o.GetName() for o in objs_r],
+                             [o.GetName() for o in objs_t])
+        self.assertTrue(all(o.file == '/tmp/test_Rdir1.root' for o in objs_t))
+        objs_t = rdir_helper.read('/tmp/test_Rdir0.root:/dirc/dird',
+                                  nworkers=2)
+        self.assertListEqual(['dire', 'histy'],
+                             sorted(o.GetName() for o in objs_t))
+
+    def test_prefetch(self):
+        rdir_helper = Rdir(self.fnames + ['/tmp/nonexistent.root'],
+                           index=True, prefetch=True)
+        self.assertListEqual(['dira', 'dirb', 'dirc'], rdir_helper.ls_names(
+            '/tmp/test_Rdir0.root:', robj_t=ROOT.TDirectoryFile))
+        failed = rdir_helper.poll(wait=True)
+        self.assertEqual([fname for fname, err in failed],
+                         ['/tmp/nonexistent.root'])
+        self.assertEqual(failed, rdir_helper.errors)
+        self.assertEqual(sorted(rdir_helper.filenames), self.fnames)
+        self.assertIn('/tmp/test_Rdir1.root:/hist2', rdir_helper.index)
+
+    def test_pool(self):
+        rdir_helper = Rdir([], index=True)
+        rdir_helper.pool.maxopen = 1
+        names = rdir_helper.ls_names('/tmp/test_Rdir0.root:/dira')
+        rdir_helper.ls_names('/tmp/test_Rdir1.root:/dira')
+        self.assertEqual(rdir_helper.filenames, self.fnames)
+        self.assertEqual(len(rdir_helper.files), 1)
+        self.assertFalse(rdir_helper.pool.isopen('/tmp/test_Rdir0.root'))
+        self.assertIn('/tmp/test_Rdir0.root:/dira/hista', rdir_helper.index)
+        keys = rdir_helper.ls('/tmp/test_Rdir0.root:/dira')  # reopens
+        self.assertEqual([key.GetName() for key in keys], names)
+        self.assertTrue(rdir_helper.pool.isopen('/tmp/test_Rdir0.root'))
+
+    def test_files_order(self):
+        rdir_helper = Rdir(self.fnames)
+        rdir_helper.ls(self.fnames[0] + ':/dira')  # most recently used
+        self.assertEqual([rfile.GetName() for rfile in rdir_helper.files],
+                         self.fnames)
+        rdir_helper = Rdir(list(reversed(self.fnames)), prefetch=True)
+        rdir_helper.poll(wait=True)
+        self.assertEqual(rdir_helper.filenames, list(reversed(self.fnames)))
+
+    def test_pool_workers(self):
+        pool = Rfilepool(maxopen=3)
+        pool.get(self.fnames[0])
+        handles = [pool.checkout(self.fnames[1]) for i in range(2)]
+        for rfile in handles:
+            pool.checkin(self.fnames[1], rfile)
+        self.assertEqual(len(pool.handles()), 1)
+        # extra handles count towards maxopen, and are closed first
+        pool.maxopen = 2
+        pool.get(self.fnames[0])
+        self.assertTrue(pool.isopen(self.fnames[0]))
+        self.assertFalse(handles[0].IsOpen())
+        self.assertIs(pool.checkout(self.fnames[1]), handles[1])  # reused
+        pool.checkin(self.fnames[1], handles[1])
+        pool.close()
@@ -2,7 +2,7 @@ import unittest
 import os
 from fixes import ROOT
 from ROOT import TH1F, TF1
-from rplot import arrange, Rplot
+from rplot import arrange, plottable_sig, Rplot, Rjob, render
 from string import ascii_lowercase
 
 __pngfile__ = '/tmp/test.png'
@@ -19,6 +19,12 @@ def tearDownModule():
 
 
 # utilities
+class _Crash(object):
+    """Kills the process unpickling it, like a crash in ROOT"""
+    def __reduce__(self):
+        return (os._exit, (1,))
+
+
 def fill_hists(hists, fns):
     """Fill histograms using given functions"""
     for i, hist in enumerate(hists):
@@ -115,3 +121,153 @@ class test_Rplot(unittest.TestCase):
             ref_counts.reverse()
             self.assertListEqual(ref_counts, [pl.GetEntries()
                                               for pl in primitives])
+
+    def test_export(self):
+        plotter = Rplot(2, 1)   # batch mode, default size
+        self.assertEqual(plotter.size, (2 * plotter.pad_size[0],
+                                        plotter.pad_size[1]))
+        pages = [self.plots[0:2], self.plots[2:4], self.plots[1:3]]
+        files = plotter.export(pages, 'hist', '/tmp/test_export_{}.png')
+        files += plotter.export(pages, 'hist', '/tmp/test_export.pdf')
+        self.assertEqual(len(files), 4)
+        for fname in files:
+            self.assertTrue(os.path.exists(fname))
+            os.remove(fname)
+        self.assertRaises(ValueError, plotter.export, pages, 'hist',
+                          '/tmp/test_export.png')
+
+    def test_render(self):
+        rfile = ROOT.TFile.Open('/tmp/test_render.root', 'recreate')
+        for hist in self.hists2:
+            rfile.WriteTObject(hist)
+        rfile.Close()
+        paths = ['/tmp/test_render.root:/{}'.format(h.GetName())
+                 for h in self.hists2]
+        jobs = [
+            Rjob([[paths[0:3], paths[3:6]]], 'hist', '/tmp/test_render0.png',
+                 grid=(2, 1)),
+            Rjob([self.plots[2:4]], 'hist', '/tmp/test_render1.png',
+                 grid=(2, 1), stack=True),
+            Rjob([['/tmp/test_render.root:/nohist']], 'hist',
+                 '/tmp/test_render2.png'),
+        ]
+        results = render(jobs, nproc=2)
+        os.remove('/tmp/test_render.root')
+        self.assertListEqual([job.output for job in jobs],
+                             [res.output for res in results])
+        for res in results[:2]:
+            self.assertIsNone(res.error)
+            self.assertTrue(os.path.exists(res.files[0]))
+            os.remove(res.files[0])
+        self.assertTrue(results[2].error)
+
+    def test_render_crash(self):
+        from concurrent.futures.process import BrokenProcessPool
+        job = Rjob([[self.plots[0]]], 'hist', '/tmp/test_render3.png')
+        job.pages = _Crash()
+        with self.assertRaises(BrokenProcessPool):
+            render([job], nproc=1)
+
+    def test_plottable_sig(self):
+        hist = TH1F('hsig', '', 10, 0, 10)
+        hist.Fill(1)
+        sig = plottable_sig(hist)
+        hist.Reset()
+        hist.Fill(2)            # same entries, and sum of weights
+        self.assertNotEqual(sig, plottable_sig(hist))
+        sig = plottable_sig(hist)
+        hist.SetBinError(3, 5)
+        self.assertNotEqual(sig, plottable_sig(hist))
+        sig = plottable_sig(hist)
+        hist.SetLineColor(ROOT.kRed)
+        self.assertNotEqual(sig, plottable_sig(hist))
+        self.assertEqual(plottable_sig(hist), plottable_sig(hist))
+
+    def test_incremental(self):
+        hists = [TH1F('hinc{}'.format(i), '', 100, -10, 10) for i in range(4)]
+        fns = [TF1('fninc{}'.format(i), 'TMath::Gaus(x, {}, 1)'.format(i),
+                   -10, 10) for i in range(len(hists))]
+        fill_hists(hists, fns)
+        plots = [hists[0:2], hists[2:4]]
+        plotter = Rplot(2, 1, 800, 400)
+        plotter.stack = True
+        plotter.incremental = True
+        plotter.draw_hist(list(plots), 'hist')
+        stacked = list(plotter.plots)
+        plotter.draw_hist(list(plots), 'hist')
+        self.assertIs(stacked[0], plotter.plots[0])
+        hists[3].Fill(0.5)
+        plotter.draw_hist(list(plots), 'hist')
+        self.assertIs(stacked[0], plotter.plots[0])
+        self.assertIsNot(stacked[1], plotter.plots[1])
+        self.assertEqual(plotter.plots[1][0].GetEntries(), 2001)
+        plotter.touch([0])
+        plotter.draw_hist(list(plots), 'hist')
+        self.assertIsNot(stacked[0], plotter.plots[0])
+
+    def test_stack_reuse(self):
+        plots = self.plots[2:]
+        plotter = Rplot(2, 1, 1200, 400)
+        plotter.stack = True
+        plotter.draw_hist(list(plots), 'hist')
+        stacked = plotter.plots[0]
+        top = plots[0][0].Clone('top')
+        for pl in plots[0][1:]:
+            top.Add(pl)
+        self.assertAlmostEqual(stacked[0].GetSumOfWeights(),
+                               top.GetSumOfWeights(), places=2)
+        self.assertAlmostEqual(stacked[0].GetBinError(50),
+                               top.GetBinError(50), places=4)
+        self.assertFalse(ROOT.gDirectory.FindObject(stacked[0].GetName()))
+        plotter.draw_hist(list(plots), 'hist')
+        self.assertIs(stacked[0], plotter.plots[0][0])
+        plotter.clear_stack()
+        self.assertFalse(plotter.stacked)
+
+    def test_stack_binning(self):
+        import numpy as np
+        plotter = Rplot(1, 1, 400, 400)
+        plotter.stack = True
+        hists = [TH1F('hbin0', '', 10, 0, 10), TH1F('hbin1', '', 10, 0, 20)]
+        self.assertRaises(ValueError, plotter.stack_plot, hists, 0)
+        edges = [0., 1., 2., 4., 6., 7., 8., 8.5, 9., 9.5, 10.]
+        hists[1] = ROOT.TH1F('hbin2', '', 10, np.array(edges))
+        self.assertRaises(ValueError, plotter.stack_plot, hists, 0)
+        hists[1] = TH1F('hbin3', '', 10, 0, 10)
+        self.assertEqual(len(plotter.stack_plot(hists, 0)), 2)
+
+    def test_viewport(self):
+        hist = TH1F('hist_vp', '', 10, 0, 10)
+        for i in range(10):
+            hist.SetBinContent(i+1, i)
+            hist.SetBinError(i+1, 2)
+        plotter = Rplot(1, 1, 400, 400)
+        ymin, ymax = plotter.get_viewport([hist], logy=False)
+        self.assertAlmostEqual(ymin, -2*1.03)
+        self.assertAlmostEqual(ymax, 11*1.03)
+        ymin, ymax = plotter.get_viewport([hist], logy=True)
+        self.assertTrue(0 < ymin < 1)
+        self.assertTrue(ymax > 11)
+        hist.SetBinContent(10, 20)
+        self.assertAlmostEqual(plotter.get_viewport([hist], logy=False)[1],
+                               22*1.03)
+        hist.Reset()            # refilled to the same totals
+        for i in range(10):
+            hist.SetBinContent(i+1, 9 - i)
+            hist.SetBinError(i+1, 2)
+        hist.SetBinContent(1, 20)
+        hist.SetBinContent(10, 0)
+        hist.GetXaxis().SetRange(2, 10)
+        self.assertAlmostEqual(plotter.get_viewport([hist], logy=False)[1],
+                               10*1.03)
+
+    def test_viewport_normalised(self):
+        hist = TH1F('hist_vpn', '', 10, 0, 10)
+        for i in range(10):
+            hist.SetBinContent(i+1, 10)
+        plotter = Rplot(1, 1, 400, 400)
+        canvas = plotter.draw_hist([[hist]], 'hist', normalised=True)
+        pad = canvas.cd(1)
+        pad.Update()
+        self.assertAlmostEqual(pad.GetUymin(), 0)
+        self.assertAlmostEqual(pad.GetUymax(), 0.1*1.03, places=5)
@@ -0,0 +1,53 @@
+import unittest
+import os
+import json
+from fixes import ROOT
+from rprof import Rprof, stage, count_clones
+from utils import thn2array
+
+
+def setUpModule():
+    ROOT.gROOT.SetBatch(True)
+    ROOT.gErrorIgnoreLevel = ROOT.kWarning
+
+
+class test_Rprof(unittest.TestCase):
+    def setUp(self):
+        self.hist = ROOT.TH1F('hist', '', 20, -3, 3)
+        self.hist.FillRandom('gaus', 1000)
+        self.fname = '/tmp/test_rprof.json'
+
+    def tearDown(self):
+        del self.hist
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def test_stages(self):
+        thn2array(self.hist)    # not recorded
+        with Rprof() as prof:
+            with stage('report'):
+                for i in range(3):
+                    thn2array(self.hist, err=True)
+                count_clones(2)
+        thn2array(self.hist)
+        self.assertEqual(list(prof.stats), ['thn2array', 'report'])
+        self.assertEqual(prof.stats['thn2array']['calls'], 3)
+        self.assertEqual(prof.stats['report']['clones'], 2)
+        self.assertGreaterEqual(prof.stats['report']['wall'],
+                                prof.stats['thn2array']['wall'])
+        self.assertEqual(len(prof.collapsed()), 2)
+        self.assertTrue(prof.collapsed()[0].startswith('report;thn2array '))
+
+    def test_export(self):
+        with Rprof() as prof:
+            thn2array(self.hist)
+        prof.dump_json(self.fname)
+        with open(self.fname) as infile:
+            res = json.load(infile)
+        self.assertEqual(res['stages']['thn2array']['calls'], 1)
+        self.assertEqual(res['calls'][0]['stack'], ['thn2array'])
+        prof.dump_trace(self.fname)
+        with open(self.fname) as infile:
+            res = json.load(infile)
+        self.assertEqual(res['traceEvents'][0]['ph'], 'X')
+        self.assertEqual(res['traceEvents'][0]['name'], 'thn2array')
@@ -2,7 +2,9 @@ import unittest
 import os
 import numpy as np
 from fixes import ROOT
-from tselect import Tsplice, Tselect, redirect2hist, parse_hist_name
+from utils import thn2array
+from tselect import (Tsplice, Tselect, Tsplicecache, Tbitmap,
+                     redirect2hist, parse_hist_name, split_varexp)
 
 
 def setUpModule():
@@ -30,8 +32,9 @@ def setUpModule():
 
 
 def tearDownModule():
-    if os.path.exists('/tmp/testtree.root'):
-        os.remove('/tmp/testtree.root')
+    for fname in ['/tmp/testtree.root', '/tmp/testsplices.root']:
+        if os.path.exists(fname):
+            os.remove(fname)
 
 
 def nplotted(tree, plot, selection=''):
@@ -108,6 +111,179 @@ class test_Tsplice(unittest.TestCase):
         tree = self.splice.make_splice('bar', cut, append=True)
         self.assertEqual(self.nentries, nplotted(tree, 'bar'))
 
+    def test_set_algebra(self):
+        self.splice.make_splice('sz_gt_3', 'sz>3')
+        self.splice.make_splice('baz_gt_30', 'baz>30')
+        tree = self.splice.reset()
+        ops = [('union', 'sz>3||baz>30'), ('intersection', 'sz>3&&baz>30'),
+               ('difference', 'sz>3&&!(baz>30)')]
+        for op, cut in ops:
+            elist = getattr(self.splice, op)(op, 'sz_gt_3', 'baz_gt_30')
+            self.assertEqual(elist.GetN(), nplotted(tree, 'sz', cut))
+            tree = self.splice.get_splice(op)
+            self.assertEqual(nplotted(tree, 'sz'), nplotted(
+                self.splice.reset(), 'sz', cut))
+        elist = self.splice.difference('none', 'all', 'sz_gt_3', 'union')
+        self.assertEqual(elist.GetN(), nplotted(tree, 'sz',
+                                                '!(sz>3||baz>30)'))
+
+    def test_set_algebra_temporaries(self):
+        self.splice.make_splice('sz_gt_3', 'sz>3')
+        self.splice.make_splice('baz_gt_30', 'baz>30')
+        self.splice.intersection('both', 'sz_gt_3', 'baz_gt_30')
+        self.splice.union('any', 'all', 'sz_gt_3')
+        names = [obj.GetName() for obj in ROOT.gDirectory.GetList()]
+        self.assertLessEqual(names.count('both'), 1)
+        self.assertFalse([name for name in names
+                          if name.startswith('elist_')])
+
+    def test_bitmap(self):
+        tree = self.splice.make_splice('sz_gt_3', 'sz>3', 'bitmap')
+        self.assertEqual(self.splice.get_entries(), nplotted(
+            self.splice.reset(), 'sz', 'sz>3'))
+        self.splice.make_splice('baz_gt_30', 'baz>30')
+        bitmap = self.splice.intersection('both', 'sz_gt_3', 'baz_gt_30')
+        self.assertIsInstance(bitmap, Tbitmap)
+        self.assertEqual(bitmap.GetN(), nplotted(
+            self.splice.reset(), 'sz', 'sz>3&&baz>30'))
+        tree = self.splice.get_splice('both')
+        self.assertEqual(nplotted(tree, 'sz'), bitmap.GetN())
+        self.assertTrue(np.all(np.diff(bitmap.entries()) > 0))
+
+    def test_bitmap_release(self):
+        self.splice.make_splice('sz_gt_3', 'sz>3', 'bitmap')
+        bitmap = self.splice.elists['sz_gt_3']
+        self.assertTrue(bitmap._elist)
+        tree = self.splice.reset()
+        self.assertIsNone(bitmap._elist)
+        self.assertFalse(tree.GetEntryList())
+        self.splice.get_splice('sz_gt_3')
+        self.assertTrue(bitmap._elist)
+
+    def test_bitmap_memory(self):
+        # scattered selections: 1 bit per entry, at most
+        bitmap = Tbitmap.from_tree(self.splice.reset(), 'sz>3')
+        self.assertLessEqual(bitmap.nbytes, 8192)
+        nentries = 10**6
+        entries = np.arange(0, nentries, 3)
+        bitmap = Tbitmap.from_entries(entries, nentries)
+        self.assertLessEqual(bitmap.nbytes, nentries / 8. + 8192)
+        self.assertTrue(np.array_equal(bitmap.entries(), entries))
+        runs = Tbitmap([10, 200000], [150000, 200005], nentries)
+        both = bitmap & runs
+        self.assertEqual(both.GetN(), len(np.intersect1d(
+            entries, np.r_[10:150000, 200000:200005])))
+        self.assertLess(runs.nbytes, 64)
+
+    def test_cutflow(self):
+        cuts = [('sz_gt_3', 'sz>3'), ('baz_gt_30', 'baz>30'),
+                ('nve_bar', ROOT.TCut('bar<0'))]
+        steps = self.splice.cutflow(cuts, weight='foo')
+        self.assertEqual([step.name for step in steps],
+                         ['all'] + [name for name, cut in cuts])
+        self.assertEqual(steps[0].entries, self.nentries)
+        selection = []
+        for step, (name, cut) in zip(steps[1:], cuts):
+            selection.append(str(cut))
+            cut = '&&'.join(selection)
+            tree = self.splice.reset()
+            self.assertEqual(step.entries, nplotted(tree, 'sz', cut))
+            hist = ROOT.TH1D('hfoo', '', 1, 0, 2)
+            tree.Draw('1>>hfoo', '({})*foo'.format(cut), 'goff')
+            self.assertAlmostEqual(step.sumw / hist.GetSumOfWeights(), 1)
+            tree = self.splice.get_splice(name)
+            self.assertEqual(nplotted(tree, 'sz'), step.entries)
+        self.assertAlmostEqual(steps[-1].cumeff,
+                               float(steps[-1].entries) / self.nentries)
+        self.assertAlmostEqual(steps[-1].wcumeff,
+                               steps[-1].sumw / steps[0].sumw)
+        self.assertAlmostEqual(steps[2].weff, steps[2].sumw / steps[1].sumw)
+        with self.assertRaises(ValueError):
+            self.splice.cutflow([('data_gt_100', 'data>100')])
+        steps = self.splice.cutflow([('any_gt_100', 'Sum$(data>100)>0')])
+        self.assertEqual(steps[1].entries,
+                         nplotted(self.splice.reset(), 'sz',
+                                  'Sum$(data>100)>0'))
+
+    def test_iterate(self):
+        tree = self.splice.make_splice('sz_gt_3', 'sz>3')
+        nentries, ndata, nchunks = 0, 0, 0
+        for chunk in self.splice.iterate(['foo', 'sz', 'data'], 100,
+                                         'baz>30'):
+            values, counts = chunk['data']
+            self.assertTrue(np.all(chunk['sz'] > 3))
+            self.assertTrue(np.all(counts == chunk['sz']))
+            self.assertEqual(values.size, counts.sum())
+            nentries += chunk['foo'].size
+            ndata += values.size
+            nchunks += 1
+        self.assertEqual(nchunks, -(-self.splice.get_entries() // 100))
+        self.assertEqual(nentries, nplotted(tree, 'foo', 'baz>30'))
+        self.assertEqual(ndata, nplotted(tree, 'data', 'baz>30'))
+
+    def test_iterate_types(self):
+        tree = ROOT.TTree('bigtree', '')
+        tree.SetDirectory(0)
+        big = np.array([0], dtype=np.int64)
+        tree.Branch('big', big, 'big/L')
+        for i in range(10):
+            big[0] = 2**53 + i
+            tree.Fill()
+        chunk = next(Tselect(tree).iterate(['big', 'big/2.'], 100,
+                                           'Entry$%2'))
+        self.assertEqual(chunk['big'].dtype, np.int64)
+        self.assertListEqual(list(chunk['big']),
+                             [2**53 + i for i in range(1, 10, 2)])
+        self.assertEqual(chunk['big/2.'].dtype, np.float64)
+        with self.assertRaises(ValueError):
+            next(self.splice.iterate(['foo'], 100, 'data>100'))
+
+    def test_prune(self):
+        cut = ROOT.TCut('foo>10&&data[0]>100')
+        nexpected = nplotted(self.splice.reset(), 'foo', cut)
+        self.tree.SetBranchStatus('baz', 0)
+        tree = self.splice.make_splice('foo_gt_10_pruned', cut)
+        self.assertFalse(tree.GetBranchStatus('baz'))
+        self.assertTrue(tree.GetBranchStatus('bar'))
+        self.tree.SetBranchStatus('baz', 1)
+        self.assertEqual(nexpected, nplotted(tree, 'foo'))
+
+    def test_cache(self):
+        cache = Tsplicecache('/tmp/testsplices.root', maxentries=2)
+        splice = Tsplice(self.splice.reset(), cache=cache)
+        cut = ROOT.TCut('foo>10')
+        nexpected = nplotted(splice.make_splice('foo_gt_10_c', cut), 'foo')
+        self.assertTrue(cache.get(self.tree, ' foo > 10', 'entrylist'))
+        self.assertFalse(cache.get(self.tree, 'foo>10', ''))
+        splice = Tsplice(splice.reset(), cache=cache)
+        tree = splice.make_splice('foo_gt_10_cached', 'foo > 10')
+        self.assertEqual(nexpected, nplotted(tree, 'foo'))
+        # least recently used is evicted
+        splice.make_splice('bar_lt_0_c', 'bar<0')
+        splice.make_splice('baz_lt_30_c', 'baz<30')
+        self.assertFalse(cache.get(self.tree, 'foo>10', 'entrylist'))
+        self.assertTrue(cache.get(self.tree, 'bar<0', 'entrylist'))
+
+    def test_treecache(self):
+        self.splice.set_cache(10 * 1024**2)
+        self.splice.make_splice('foo_gt_10_tc', 'foo>10')
+        report = self.splice.reports[-1]
+        self.assertEqual(report.operation, 'make_splice')
+        self.assertEqual(report.branches, ['foo'])
+        self.assertEqual(self.tree.GetCacheSize(), 10 * 1024**2)
+        self.splice.set_cache(0)
+        self.splice.make_splice('foo_gt_20_tc', 'foo>20')
+        self.assertEqual(len(self.splice.reports), 2)
+        self.assertIsNone(self.splice.reports[-1].branches)
+        self.assertIsNone(self.splice.reports[-1].efficiency)
+        # prefetching is only enabled during operations
+        prefetch = ROOT.gEnv.GetValue('TFile.AsyncPrefetching', 0)
+        self.splice.set_cache(10 * 1024**2, prefetch=True)
+        self.splice.make_splice('foo_gt_30_tc', 'foo>30')
+        self.assertEqual(ROOT.gEnv.GetValue('TFile.AsyncPrefetching', 0),
+                         prefetch)
+        self.splice.set_cache(0)
+
     def test_layered(self):
         splice = Tsplice(self.splice.reset(), layered=True)
         splice.make_splice('pos_bar', 'bar>0')
@@ -132,6 +308,10 @@ class test_helpers(unittest.TestCase):
         name = parse_hist_name(self.expr_app[0])
         self.assertEqual(name, 'hist')
 
+    def test_split_varexp(self):
+        self.assertListEqual(split_varexp('TMath::Abs(foo):data[sz-1]'),
+                             ['TMath::Abs(foo)', 'data[sz-1]'])
+
 
 class test_Tselect(unittest.TestCase):
     def setUp(self):
@@ -155,3 +335,57 @@ class test_Tselect(unittest.TestCase):
         hs = self.selector.fill_hists()
         self.assertAlmostEqual(hs[0].GetEntries(), self.nentries/3., delta=1)
         self.assertAlmostEqual(hs[1].GetEntries(), 5*self.nentries/3., delta=2)
+
+    def test_fill_hist_treecache(self):
+        self.selector.set_cache(10 * 1024**2, branches=['sz', 'foo'])
+        self.selector.exprs = [('foo>>hist6', 'sz>4')]
+        self.selector.fill_hists()
+        report = self.selector.reports[-1]
+        self.assertEqual(report.operation, 'fill_hists')
+        self.assertEqual(report.branches, ['foo', 'sz'])
+        self.assertGreaterEqual(report.readcalls, 0)
+
+    def test_fill_hist_parallel(self):
+        self.selector.exprs = [
+            ('foo>>hist3(50, 0, 100)', 'sz>4'),
+            ('data>>hist4(50, 0, 2000)', 'sz>4'),
+            ('bar>>hist5', '')
+        ]
+        hs = self.selector.fill_hists(nproc=2)
+        self.assertEqual(len(hs), 3)
+        self.assertAlmostEqual(hs[0].GetEntries(), self.nentries/3., delta=1)
+        self.assertAlmostEqual(hs[1].GetEntries(), 5*self.nentries/3., delta=2)
+        self.assertEqual(hs[2].GetEntries(), self.nentries)
+
+    def test_fill_hist_in_memory(self):
+        ROOT.gROOT.cd()
+        tree = self.tree.CopyTree('')
+        self.rfile.cd()
+        self.assertIsNone(Tsplicecache('/tmp/testsplices.root').key(
+            tree, 'foo>10', 'entrylist'))
+        selector = Tselect(tree)
+        selector.exprs = [('foo>>hist7(50, 0, 100)', '')]
+        hs = selector.fill_hists(nproc=2)   # falls back to one process
+        self.assertEqual(hs[0].GetEntries(), self.nentries)
+
+    def test_fill_hist_onepass(self):
+        exprs = [
+            ('foo>>hist{}(50, 0, 100)', 'sz>4'),
+            ('data>>hist{}(50, 0, 2000)', 'sz>4'),
+            ('bar:foo>>hist{}(50, 0, 100, 20, -5, 5)', 'baz')
+        ]
+        self.selector.exprs = [(e.format(i), sel)
+                               for i, (e, sel) in enumerate(exprs)]
+        hs_r = self.selector.fill_hists()
+        self.selector.exprs = [(e.format(i+10), sel)
+                               for i, (e, sel) in enumerate(exprs)]
+        hs_t = self.selector.fill_hists(onepass=True)
+        for h_r, h_t in zip(hs_r, hs_t):
+            self.assertEqual(h_r.GetEntries(), h_t.GetEntries())
+            self.assertAlmostEqual(h_r.GetSumOfWeights(),
+                                   h_t.GetSumOfWeights(), places=3)
+            self.assertTrue(np.allclose(
+                thn2array(h_r, err=True, overflow=True),
+                thn2array(h_t, err=True, overflow=True)))
+        # branch status is restored
+        self.assertTrue(self.tree.GetBranchStatus('bar'))
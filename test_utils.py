@@ -0,0 +1,107 @@
+import unittest
+import os
+import hashlib
+from fixes import ROOT
+from utils import thn2array, thnbins, file_hash
+import numpy as np
+
+
+def setUpModule():
+    ROOT.gROOT.SetBatch(True)
+    ROOT.gErrorIgnoreLevel = ROOT.kWarning
+
+
+class test_thn2array(unittest.TestCase):
+    def setUp(self):
+        self.hist1 = ROOT.TH1F('hist1', '', 20, -3, 3)
+        self.hist1.FillRandom('gaus', 1000)
+        self.hist2 = ROOT.TH2D('hist2', '', 8, -3, 3, 5, -3, 3)
+        self.hist2.Sumw2()
+        for i in range(1000):
+            self.hist2.Fill(np.random.normal(), np.random.normal(), 0.5)
+
+    def tearDown(self):
+        del self.hist1, self.hist2
+
+    def test_1d(self):
+        val = thn2array(self.hist1, err=True)
+        ref = [(self.hist1.GetBinContent(i), self.hist1.GetBinError(i))
+               for i in range(1, 21)]
+        self.assertEqual(np.shape(val), (2, 20))
+        self.assertTrue(np.allclose(np.transpose(ref), val))
+
+    def test_overflow(self):
+        val = thn2array(self.hist1, overflow=True)
+        ref = [self.hist1.GetBinContent(i) for i in range(22)]
+        self.assertTrue(np.allclose(ref, val))
+
+    def test_2d(self):
+        val = thn2array(self.hist2, err=True, asym=True, pair=True,
+                        shaped=True)
+        self.assertEqual(np.shape(val), (5, 8, 3))
+        for x, y in [(1, 1), (4, 3), (8, 5)]:
+            self.assertAlmostEqual(val[y-1, x-1, 0],
+                                   self.hist2.GetBinContent(x, y))
+            self.assertAlmostEqual(val[y-1, x-1, 1],
+                                   self.hist2.GetBinErrorUp(x, y))
+        self.assertEqual(np.shape(thn2array(self.hist2)), (40,))
+        # same layout w/o pairing
+        unpaired = thn2array(self.hist2, err=True, shaped=True)
+        self.assertEqual(np.shape(unpaired), (2, 5, 8))
+        self.assertTrue(np.allclose(unpaired[0], val[..., 0]))
+
+
+class test_thnbins(unittest.TestCase):
+    def setUp(self):
+        edges = np.array([0., 1., 3., 6., 10.])
+        self.hist1 = ROOT.TH1D('hist1', '', 4, edges)
+        self.hist2 = ROOT.TH2F('hist2', '', 10, -5, 5, 4, edges)
+
+    def tearDown(self):
+        del self.hist1, self.hist2
+
+    def test_variable(self):
+        xaxis = self.hist1.GetXaxis()
+        centres, lows, widths = thnbins(self.hist1, edges=True, width=True,
+                                        overflow=True)
+        for i in range(6):
+            self.assertAlmostEqual(centres[i], xaxis.GetBinCenter(i))
+            self.assertAlmostEqual(lows[i], xaxis.GetBinLowEdge(i))
+            self.assertAlmostEqual(widths[i], xaxis.GetBinWidth(i))
+
+    def test_axes(self):
+        xbins, ybins = thnbins(self.hist2, edges=True, pair=True)
+        self.assertEqual(np.shape(xbins), (10, 2))
+        self.assertEqual(np.shape(ybins), (4, 2))
+        yaxis = self.hist2.GetYaxis()
+        ref = [yaxis.GetBinCenter(i) for i in range(1, 5)]
+        self.assertTrue(np.allclose(ref, ybins[:, 0]))
+
+
+class test_file_hash(unittest.TestCase):
+    def setUp(self):
+        self.fname = '/tmp/test_file_hash.root'
+        rfile = ROOT.TFile.Open(self.fname, 'recreate')
+        for i in range(10):
+            hist = ROOT.TH1F('hist{}'.format(i), '', 100, -3, 3)
+            hist.FillRandom('gaus', 1000)
+            rfile.WriteTObject(hist)
+        rfile.Close()
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_chunked(self):
+        with open(self.fname, 'rb') as myfile:
+            ref = hashlib.sha1(myfile.read()).hexdigest()
+        self.assertEqual(ref, file_hash(self.fname, 'sha1', chunksize=1000))
+
+    def test_fast(self):
+        fingerprint = file_hash(self.fname, fast=True, chunksize=256)
+        self.assertEqual(fingerprint,
+                         file_hash(self.fname, fast=True, chunksize=256))
+        rfile = ROOT.TFile.Open(self.fname, 'update')
+        rfile.WriteTObject(ROOT.TH1F('newhist', '', 10, 0, 1))
+        rfile.Close()
+        self.assertNotEqual(fingerprint,
+                            file_hash(self.fname, fast=True, chunksize=256))
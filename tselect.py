@@ -4,6 +4,9 @@
 from __future__ import print_function
 
 from fixes import ROOT
+from rprof import profiled
+
+from collections import namedtuple
 
 
 def redirect2hist(pair):
@@ -26,8 +29,700 @@ def parse_hist_name(expr):
         return expr[start:]
 
 
+def parse_hist_binning(expr):
+    """Return parsed histogram binning as a list, None if absent"""
+    start = expr.find('(', expr.find('>>'))
+    if start < 0:
+        return None
+    try:
+        return [float(val) for val in
+                expr[start+1:expr.rfind(')')].split(',')]
+    except ValueError:
+        return None
+
+
+def split_varexp(varexp):
+    """Split TTree::Draw variable expression at `:' (not `::', brackets)"""
+    parts, depth, start, i = [], 0, 0, 0
+    while i < len(varexp):
+        if varexp[i] in '([':
+            depth += 1
+        elif varexp[i] in ')]':
+            depth -= 1
+        elif varexp[i] == ':' and depth == 0:
+            if varexp[i:i+2] == '::':
+                i += 2
+                continue
+            parts.append(varexp[start:i])
+            start = i + 1
+        i += 1
+    parts.append(varexp[start:])
+    return parts
+
+
+def formula_branches(tree, expr):
+    """Return set of (top-level) branches used by a formula expression.
+
+       expr may also be a compiled TTreeFormula.  Returns None if the
+       expression does not compile.
+
+    """
+    if isinstance(expr, ROOT.TTreeFormula):
+        form = expr
+    else:
+        if not tree.GetTree():  # chain w/o a loaded tree
+            tree.LoadTree(0)
+        form = ROOT.TTreeFormula('formula_branches', str(expr), tree)
+    if not form.GetNdim():
+        return None
+    branches = set()
+    for i in range(form.GetNcodes()):
+        leaf = form.GetLeaf(i)
+        # also need the branch with array sizes, e.g. sz for data[sz]
+        for lf in filter(None, (leaf, leaf and leaf.GetLeafCount())):
+            branches.add(lf.GetBranch().GetMother().GetName())
+    return branches
+
+
+def iter_branches(branches):
+    """Iterate over branches, and their sub-branches (parents first)"""
+    for branch in branches:
+        yield branch
+        for sub in iter_branches(branch.GetListOfBranches()):
+            yield sub
+
+
+class branch_mask(object):
+    """Enable only some branches, and restore branch status when done.
+
+       >>> with branch_mask(tree, ['foo', 'bar']):
+       ...     tree.Draw('foo', 'bar>0')
+
+       If branches is None, the branch status is left as is.
+
+    """
+
+    def __init__(self, tree, branches):
+        self.tree = tree
+        self.branches = branches
+
+    def __enter__(self):
+        if self.branches is not None:
+            self.status = [(br.GetName(), self.tree.GetBranchStatus(
+                br.GetName())) for br in
+                iter_branches(self.tree.GetListOfBranches())]
+            self.tree.SetBranchStatus('*', 0)
+            for branch in self.branches:
+                self.tree.SetBranchStatus(branch, 1)
+        return self.tree
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.branches is None:
+            return
+        if all(status for name, status in self.status):
+            self.tree.SetBranchStatus('*', 1)
+        else:
+            for name, status in self.status:
+                self.tree.SetBranchStatus(name, status)
+
+
+def _book_hist(expr, nvars):
+    """Return histogram for (expression, selection), None if impossible.
+
+       An existing histogram is reused when the expression does not
+       specify binning (reset, unless it is `>>+').
+
+    """
+    name = parse_hist_name(expr[0])
+    binning = parse_hist_binning(expr[0])
+    if binning is None:
+        hist = ROOT.gROOT.FindObject(name)
+        if not isinstance(hist, ROOT.TH1) or hist.GetDimension() != nvars:
+            return None
+        if expr[0].find('>>+') < 0:
+            hist.Reset()
+        return hist
+    if nvars > 3 or len(binning) != 3 * nvars:
+        return None
+    varexp = expr[0][:expr[0].find('>>')]
+    title = '{} {{{}}}'.format(varexp, expr[1]) if expr[1] else varexp
+    hist_t = (ROOT.TH1F, ROOT.TH2F, ROOT.TH3F)[nvars-1]
+    args = []
+    for i in range(nvars):
+        args += [int(binning[3*i]), binning[3*i+1], binning[3*i+2]]
+    return hist_t(name, title, *args)
+
+
+def fill_formulas(tree, exprs, first=0, nentries=None):
+    """Fill histograms for expressions in a single pass over the tree.
+
+       All expressions (and selections) are compiled into formulas up
+       front, and only the branches they use are enabled during the
+       loop, which is compiled (see _fill_loop(..)).  As with
+       TTree::Draw(..), `y:x' fills x along the X-axis, the selection
+       is the weight, and the current entry list is respected (first
+       and nentries refer to it, when present).
+
+       Returns list of histograms in order of expressions, with None
+       for expressions that could not be filled this way (w/o binning
+       info, or not compilable).
+
+    """
+    from utils import suppress_warnings
+    suppress_warnings()
+    elist = tree.GetEventList() or tree.GetEntryList()
+    last = elist.GetN() if elist else tree.GetEntries()
+    if nentries is not None:
+        last = min(last, first + nentries)
+    tree.LoadTree(tree.GetEntryNumber(first))
+
+    hists, fills, branches = [], [], set()
+    for i, expr in enumerate(exprs):
+        hist = None
+        if expr[0]:
+            varexp = expr[0][:expr[0].find('>>')]
+            parts = split_varexp(varexp)
+            parts.reverse()     # `y:x', x on the X-axis
+            forms = [ROOT.TTreeFormula('var{}_{}'.format(i, j), part, tree)
+                     for j, part in enumerate(parts)]
+            sel = ROOT.TTreeFormula('sel{}'.format(i), str(expr[1]), tree) \
+                if expr[1] else None
+            used = [formula_branches(tree, form)
+                    for form in ([sel] if sel else []) + forms]
+            if None not in used:
+                hist = _book_hist(expr, len(parts))
+        if hist:
+            manager = ROOT.TTreeFormulaManager()
+            # deleted by the last formula that uses it
+            ROOT.SetOwnership(manager, False)
+            for form in ([sel] if sel else []) + forms:
+                manager.Add(form)
+            manager.Sync()
+            fills.append((hist, manager, forms, sel,
+                          sel and sel.GetMultiplicity()))
+            branches.update(*used)
+        hists.append(hist)
+    if not fills:
+        return hists
+
+    with branch_mask(tree, branches):
+        _fill_loop(tree, fills, first, last)
+    return hists
+
+
+_fill_formulas_code = """
+#include "TH3.h"
+#include "TObjArray.h"
+#include "TTree.h"
+#include "TTreeFormula.h"
+#include "TTreeFormulaManager.h"
+
+void rplot_fill_formulas(TTree* tree, TObjArray* hists, TObjArray* managers,
+                         TObjArray* sels, TObjArray* forms,
+                         Long64_t first, Long64_t last)
+{
+  Int_t nfills = hists->GetEntriesFast();
+  Int_t treenum = tree->GetTreeNumber();
+  for (Long64_t i = first; i < last; ++i) {
+    Long64_t entry = tree->GetEntryNumber(i);
+    if (entry < 0 || tree->LoadTree(entry) < 0) break;
+    if (tree->GetTreeNumber() != treenum) {  // next file in chain
+      treenum = tree->GetTreeNumber();
+      for (Int_t k = 0; k < nfills; ++k) {
+        ((TTreeFormulaManager*) managers->At(k))->UpdateFormulaLeaves();
+      }
+    }
+    Double_t weight = tree->GetWeight();
+    for (Int_t k = 0; k < nfills; ++k) {
+      TH1* hist = (TH1*) hists->At(k);
+      TTreeFormulaManager* manager = (TTreeFormulaManager*) managers->At(k);
+      TTreeFormula* sel = (TTreeFormula*) sels->At(k);
+      TTreeFormula* x = (TTreeFormula*) forms->At(3*k);
+      TTreeFormula* y = (TTreeFormula*) forms->At(3*k + 1);
+      TTreeFormula* z = (TTreeFormula*) forms->At(3*k + 2);
+      Int_t ndata = manager->GetNdata(kTRUE);
+      if (!ndata) continue;
+      Bool_t multi = sel && sel->GetMultiplicity();
+      Double_t w = sel ? weight * sel->EvalInstance(0) : weight;
+      if (!(w || multi)) continue;
+      for (Int_t j = 0; j < ndata; ++j) {
+        if (j > 0 && multi) w = weight * sel->EvalInstance(j);
+        if (!w) continue;
+        if (z) {
+          ((TH3*) hist)->Fill(x->EvalInstance(j), y->EvalInstance(j),
+                              z->EvalInstance(j), w);
+        } else if (y) {
+          ((TH2*) hist)->Fill(x->EvalInstance(j), y->EvalInstance(j), w);
+        } else {
+          hist->Fill(x->EvalInstance(j), w);
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def _fill_loop(tree, fills, first, last):
+    """Fill histograms over entries [first, last) (compiled, if possible)"""
+    if not hasattr(ROOT, 'rplot_fill_formulas'):
+        ROOT.gInterpreter.Declare(_fill_formulas_code)
+    fill = getattr(ROOT, 'rplot_fill_formulas', None)
+    if fill:
+        nfills = len(fills)
+        hists, managers, sels = [ROOT.TObjArray(nfills) for i in range(3)]
+        forms = ROOT.TObjArray(3 * nfills)  # x, y, z for every fill
+        for k, (hist, manager, hforms, sel, multi) in enumerate(fills):
+            hists.AddAt(hist, k)
+            managers.AddAt(manager, k)
+            if sel:
+                sels.AddAt(sel, k)
+            for j, form in enumerate(hforms):
+                forms.AddAt(form, 3*k + j)
+        fill(tree, hists, managers, sels, forms, first, last)
+        return
+    treenum = tree.GetTreeNumber()
+    for i in range(first, last):
+        entry = tree.GetEntryNumber(i)
+        if entry < 0 or tree.LoadTree(entry) < 0:
+            break
+        if tree.GetTreeNumber() != treenum:  # next file in chain
+            treenum = tree.GetTreeNumber()
+            for hist, manager, forms, sel, multi in fills:
+                manager.UpdateFormulaLeaves()
+        weight = tree.GetWeight()
+        for hist, manager, forms, sel, multi in fills:
+            ndata = manager.GetNdata(True)
+            if not ndata:
+                continue
+            w = weight * sel.EvalInstance(0) if sel else weight
+            if not (w or multi):
+                continue
+            for j in range(ndata):
+                if j > 0 and multi:
+                    w = weight * sel.EvalInstance(j)
+                if not w:
+                    continue
+                vals = [form.EvalInstance(j) for form in forms]
+                hist.Fill(*(vals + [w]))
+
+
+def iterate(tree, columns, chunksize=100000, selection=''):
+    """Iterate over columns of a tree in chunks of entries.
+
+       columns   -- list of branch names, or formula expressions
+       chunksize -- number of entries (in the entry list, if there is
+                    one) read at a time
+       selection -- only return entries that pass the selection (must
+                    have one value per entry)
+
+       Yields a dictionary of numpy arrays, one value per selected
+       entry, for every chunk with selected entries.  Array-valued
+       columns (e.g. `data[sz]') are returned as a pair of flat values,
+       and the number of values per entry; per-entry arrays are
+       numpy.split(values, numpy.cumsum(counts)[:-1]).  Integer
+       columns are returned as int64 (w/o a round trip through double),
+       others as float64.
+
+       All columns are read in one pass over every chunk with compiled
+       formulas (see _iterate_loop(..)), into buffers allocated once,
+       so memory use is bounded by the chunk size.  As with
+       TTree::Draw(..), entries where a scalar column has no value are
+       skipped.  The current entry list is respected, and only the
+       branches used are enabled while iterating.
+
+    """
+    import numpy as np
+    from utils import rbuffer
+    if isinstance(selection, ROOT.TCut):
+        selection = selection.GetTitle()
+    selection = str(selection or '')
+    columns = list(columns)
+    if not tree.GetTree():      # chain w/o a loaded tree
+        tree.LoadTree(0)
+    forms, branches = [], set()
+    for i, expr in enumerate([selection] + columns):
+        if i == 0 and not expr:
+            continue
+        form = ROOT.TTreeFormula('iterate{}'.format(i), str(expr), tree)
+        used = formula_branches(tree, form)
+        if used is None:
+            raise ValueError('Invalid expression: {}'.format(expr))
+        branches.update(used)
+        forms.append(form)
+    sel = forms.pop(0) if selection else None
+    if sel and sel.GetMultiplicity():
+        raise ValueError('Selection with more than one value per entry: '
+                         '{}'.format(selection))
+
+    # buffer, and slot in the buffer, for every column
+    kinds = [(bool(form.GetMultiplicity()), bool(form.IsInteger()))
+             for form in forms]
+    slots, nslots = [], {}
+    for kind in kinds:
+        slots.append(nslots.get(kind, 0))
+        nslots[kind] = slots[-1] + 1
+    nscalar = {integer: nslots.get((False, integer), 0)
+               for integer in (False, True)}
+    narray = nslots.get((True, False), 0) + nslots.get((True, True), 0)
+
+    elist = tree.GetEventList() or tree.GetEntryList()
+    nentries = elist.GetN() if elist else tree.GetEntries()
+    size = max(min(chunksize, nentries), 1)
+    # np.longlong, as Long64_t* only accepts buffers of long long
+    bufs = [np.zeros(max(nscalar[False], 1) * size, dtype=float),
+            np.zeros(max(nscalar[True], 1) * size, dtype=np.longlong),
+            np.zeros(max(narray, 1) * size, dtype=np.longlong),
+            ROOT.std.vector('std::vector<Double_t>')(
+                nslots.get((True, False), 0)),
+            ROOT.std.vector('std::vector<Long64_t>')(
+                nslots.get((True, True), 0))]
+    # counts of arrays are in order of array columns
+    acounts = [i for i, (multi, integer) in enumerate(kinds) if multi]
+
+    with branch_mask(tree, branches):
+        for first in range(0, nentries, chunksize):
+            for vec in bufs[3:]:
+                for i in range(vec.size()):
+                    vec[i].clear()
+            nrows = _iterate_loop(tree, sel, forms, kinds, first,
+                                  min(first + chunksize, nentries), size,
+                                  bufs)
+            if not nrows:
+                continue
+            chunk = {}
+            for i, (expr, (multi, integer), slot) in enumerate(
+                    zip(columns, kinds, slots)):
+                if not multi:
+                    buf = bufs[int(integer)]
+                    chunk[expr] = np.array(
+                        buf[slot * size:slot * size + nrows],
+                        dtype=np.int64 if integer else float)
+                    continue
+                vec = bufs[3 + int(integer)][slot]
+                vals = rbuffer(vec.data(), vec.size(),
+                               dtype='i8' if integer else 'f8', copy=True)
+                k = acounts.index(i)
+                chunk[expr] = (vals, np.array(
+                    bufs[2][k * size:k * size + nrows], dtype=np.int64))
+            yield chunk
+
+
+_iterate_code = """
+#include <vector>
+#include "TObjArray.h"
+#include "TTree.h"
+#include "TTreeFormula.h"
+
+Long64_t rplot_iterate(TTree* tree, TObjArray* sels, TObjArray* forms,
+                       Long64_t first, Long64_t last, Long64_t size,
+                       Double_t* dvals, Long64_t* ivals, Long64_t* counts,
+                       std::vector<std::vector<Double_t> >& darrays,
+                       std::vector<std::vector<Long64_t> >& iarrays)
+{
+  TTreeFormula* sel = (TTreeFormula*) sels->At(0);
+  Int_t ncols = forms->GetEntriesFast();
+  Int_t treenum = tree->GetTreeNumber();
+  Long64_t row = 0;
+  for (Long64_t i = first; i < last && row < size; ++i) {
+    Long64_t entry = tree->GetEntryNumber(i);
+    if (entry < 0 || tree->LoadTree(entry) < 0) break;
+    if (tree->GetTreeNumber() != treenum) {  // next file in chain
+      treenum = tree->GetTreeNumber();
+      if (sel) sel->UpdateFormulaLeaves();
+      for (Int_t k = 0; k < ncols; ++k) {
+        ((TTreeFormula*) forms->At(k))->UpdateFormulaLeaves();
+      }
+    }
+    if (sel && !(sel->GetNdata() && sel->EvalInstance(0))) continue;
+    Bool_t skip = kFALSE;       // scalars w/o a value, like TTree::Draw
+    for (Int_t k = 0; k < ncols && !skip; ++k) {
+      TTreeFormula* form = (TTreeFormula*) forms->At(k);
+      skip = !form->GetMultiplicity() && !form->GetNdata();
+    }
+    if (skip) continue;
+    Int_t nd = 0, ni = 0, na = 0, nad = 0, nai = 0;
+    for (Int_t k = 0; k < ncols; ++k) {
+      TTreeFormula* form = (TTreeFormula*) forms->At(k);
+      Bool_t integer = form->IsInteger();
+      if (!form->GetMultiplicity()) {
+        if (integer) ivals[size * ni++ + row] = form->EvalInstance64(0);
+        else dvals[size * nd++ + row] = form->EvalInstance(0);
+        continue;
+      }
+      Int_t ndata = form->GetNdata();
+      counts[size * na++ + row] = ndata;
+      for (Int_t j = 0; j < ndata; ++j) {
+        if (integer) iarrays[nai].push_back(form->EvalInstance64(j));
+        else darrays[nad].push_back(form->EvalInstance(j));
+      }
+      if (integer) ++nai;
+      else ++nad;
+    }
+    ++row;
+  }
+  return row;
+}
+"""
+
+
+def _iterate_loop(tree, sel, forms, kinds, first, last, size, bufs):
+    """Read columns of selected entries in [first, last) into buffers
+       (compiled, if possible), return number of entries read.
+
+       Scalar columns are stored column by column (size values each)
+       in the float, or integer buffer, and arrays in one vector per
+       column, with their counts in the counts buffer.
+
+    """
+    dvals, ivals, counts, darrays, iarrays = bufs
+    if not hasattr(ROOT, 'rplot_iterate'):
+        ROOT.gInterpreter.Declare(_iterate_code)
+    read = getattr(ROOT, 'rplot_iterate', None)
+    if read:
+        sels, cols = ROOT.TObjArray(1), ROOT.TObjArray(max(len(forms), 1))
+        if sel:
+            sels.AddAt(sel, 0)
+        for k, form in enumerate(forms):
+            cols.AddAt(form, k)
+        return read(tree, sels, cols, first, last, size, dvals, ivals,
+                    counts, darrays, iarrays)
+    treenum, row = tree.GetTreeNumber(), 0
+    for i in range(first, last):
+        entry = tree.GetEntryNumber(i)
+        if entry < 0 or tree.LoadTree(entry) < 0 or row >= size:
+            break
+        if tree.GetTreeNumber() != treenum:  # next file in chain
+            treenum = tree.GetTreeNumber()
+            for form in ([sel] if sel else []) + forms:
+                form.UpdateFormulaLeaves()
+        if sel and not (sel.GetNdata() and sel.EvalInstance(0)):
+            continue
+        if any(not multi and not form.GetNdata()
+               for form, (multi, integer) in zip(forms, kinds)):
+            continue
+        nslots, narrays = {}, 0
+        for form, (multi, integer) in zip(forms, kinds):
+            slot = nslots.get((multi, integer), 0)
+            nslots[(multi, integer)] = slot + 1
+            if not multi:
+                buf = ivals if integer else dvals
+                buf[size * slot + row] = form.EvalInstance64(0) \
+                    if integer else form.EvalInstance(0)
+                continue
+            ndata = form.GetNdata()
+            counts[size * narrays + row] = ndata
+            narrays += 1
+            vec = (iarrays if integer else darrays)[slot]
+            for j in range(ndata):
+                vec.push_back(form.EvalInstance64(j) if integer
+                              else form.EvalInstance(j))
+        row += 1
+    return row
+
+
+def has_binning(expr):
+    """Does the histogram redirect in expression have binning info?"""
+    return expr.find('(', expr.find('>>')) > 0
+
+
+def tree_source(tree):
+    """Return tree name (with path), and list of files for a tree/chain;
+       None for trees that are not read from a file"""
+    if isinstance(tree, ROOT.TChain):
+        elements = tree.GetListOfFiles()
+        name = elements.At(0).GetName() if elements.GetEntries() \
+            else tree.GetName()
+        return (name, [el.GetTitle() for el in elements])
+    rdir = tree.GetDirectory()
+    rfile = rdir.GetFile() if rdir else None
+    if not rfile:
+        return None
+    fname = rfile.GetName()
+    path = rdir.GetPath()[len(fname)+1:].strip('/')
+    return ('/'.join(filter(None, (path, tree.GetName()))), [fname])
+
+
+def _fill_chunk(name, files, elist, exprs, templates, opts, first, nentries,
+                onepass):
+    """Fill histograms for a range of entries (in a worker process)"""
+    ROOT.gROOT.SetBatch(True)
+    for template in filter(None, templates):  # binning of existing hists
+        template.SetDirectory(ROOT.gROOT)
+    tree = ROOT.TChain(name)
+    for fname in files:
+        tree.Add(fname)
+    if isinstance(elist, ROOT.TEventList):
+        tree.SetEventList(elist)
+    elif elist:
+        tree.SetEntryList(elist)
+    hists = fill_formulas(tree, exprs, first, nentries) if onepass \
+        else [None] * len(exprs)
+    for i, expr in enumerate(exprs):
+        if not hists[i]:
+            tree.Draw(expr[0], expr[1], '{} goff'.format(opts),
+                      nentries, first)
+            hists[i] = ROOT.gROOT.FindObject(parse_hist_name(expr[0]))
+        if hists[i]:
+            hists[i].SetDirectory(0)
+    return hists
+
+
+cachereport = namedtuple('cachereport', 'operation branches bytesread '
+                         'readcalls efficiency missefficiency walltime')
+cachereport.__doc__ = """Reads of a tree operation: cached branches, bytes read
+and read calls (all files), and TTreeCache efficiencies (None when not
+available)"""
+
+
+def _read_cache(tree):
+    """Return TTreeCache of tree for the current file, None if none"""
+    rfile = tree.GetCurrentFile()
+    if not rfile:
+        return None
+    if hasattr(tree, 'GetReadCache'):
+        cache = tree.GetReadCache(rfile)
+    else:
+        cache = rfile.GetCacheRead(tree)
+    return cache or None        # null proxy w/o a cache
+
+
+class _cacheop(object):
+    """Configure cache for an operation, and report its reads"""
+
+    def __init__(self, owner, operation, exprs):
+        self.owner = owner
+        self.operation = operation
+        self.exprs = exprs
+
+    def __enter__(self):
+        import time
+        self.branches, self.prefetch = None, None
+        if self.owner.cache_size is not None:
+            if self.owner.cache_prefetch:  # restored after the operation
+                self.prefetch = ROOT.gEnv.GetValue('TFile.AsyncPrefetching',
+                                                   0)
+                ROOT.gEnv.SetValue('TFile.AsyncPrefetching', 1)
+            self.branches = self.owner._configure_cache(self.exprs)
+        self.start = (ROOT.TFile.GetFileBytesRead(),
+                      ROOT.TFile.GetFileReadCalls(), time.time())
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        import time
+        if self.prefetch is not None:
+            ROOT.gEnv.SetValue('TFile.AsyncPrefetching', self.prefetch)
+        cache = _read_cache(self.owner.tree)
+        eff, miss = (cache and getattr(cache, attr, None) for attr in
+                     ('GetEfficiency', 'GetMissEfficiency'))
+        reports = self.owner.reports
+        reports.append(cachereport(
+            self.operation, self.branches and sorted(self.branches),
+            ROOT.TFile.GetFileBytesRead() - self.start[0],
+            ROOT.TFile.GetFileReadCalls() - self.start[1],
+            eff() if eff else None, miss() if miss else None,
+            time.time() - self.start[2]))
+        del reports[:-self.owner.maxreports]
+
+
+class Ttreecache(object):
+    """Mixin to configure the TTreeCache of self.tree, and to iterate
+       over its columns with the cache (see iterate(..)).
+
+       >>> selector = Tselect(tree)
+       >>> selector.set_cache(50 * 1024**2)
+       >>> selector.fill_hists()
+       >>> print(selector.reports[-1])
+
+       Unless branches are set explicitly, the branches used by the
+       expressions of every operation are added to the cache before
+       it starts, which skips the learning phase.  Every operation
+       adds a report of its reads to reports (see cachereport), the
+       last maxreports are kept.  The configuration applies to this
+       process, not to worker processes.
+
+    """
+
+    cache_size = None           # leave the tree as is
+    cache_learn = None
+    cache_prefetch = False
+    cache_branches = None       # from expressions
+    maxreports = 100
+
+    def set_cache(self, size, learn_entries=None, prefetch=False,
+                  branches=None):
+        """Configure TTreeCache for operations on the tree.
+
+           size          -- cache size in bytes (0 disables the cache)
+           learn_entries -- entries in the learning phase, when the
+                            branches can not be found from expressions
+           prefetch      -- prefetch baskets asynchronously (sets
+                            TFile.AsyncPrefetching in gEnv during
+                            operations)
+           branches      -- branches to cache, default: branches used
+                            by the operation
+
+        """
+        self.cache_size = size
+        self.cache_learn = learn_entries
+        self.cache_prefetch = prefetch
+        self.cache_branches = branches
+
+    @property
+    def reports(self):
+        """Reports of reads by operations (see cachereport)"""
+        return self.__dict__.setdefault('_reports', [])
+
+    def _exprs_branches(self, exprs):
+        """Return branches used by expressions, None if unknown"""
+        branches = set()
+        for expr in exprs:
+            if isinstance(expr, ROOT.TCut):
+                expr = expr.GetTitle()
+            if not expr:
+                continue
+            used = formula_branches(self.tree, expr)
+            if used is None:
+                return None
+            branches.update(used)
+        return branches
+
+    def _configure_cache(self, exprs):
+        """Set up the cache for expressions, return cached branches"""
+        tree = self.tree
+        tree.SetCacheSize(self.cache_size)
+        if not self.cache_size:
+            return None
+        if self.cache_learn:
+            tree.SetCacheLearnEntries(self.cache_learn)
+        branches = self.cache_branches
+        if branches is None:
+            branches = self._exprs_branches(exprs)
+        if branches:
+            if hasattr(tree, 'DropBranchFromCache'):  # from earlier ops
+                tree.DropBranchFromCache('*', True)
+            for branch in branches:
+                tree.AddBranchToCache(branch, True)
+            tree.StopCacheLearningPhase()
+        cache = _read_cache(tree)
+        if self.cache_prefetch and cache and \
+           hasattr(cache, 'SetEnablePrefetching'):
+            cache.SetEnablePrefetching(True)
+        return branches
+
+    def _cacheop(self, operation, exprs):
+        return _cacheop(self, operation, exprs)
+
+    def iterate(self, columns, chunksize=100000, selection=''):
+        """Iterate over columns in chunks of entries (of the current
+           entry list), see iterate(..)"""
+        columns = list(columns)
+        with self._cacheop('iterate', columns + [selection]):
+            for chunk in iterate(self.tree, columns, chunksize, selection):
+                yield chunk
+
+
 # TTree selector
-class Tselect(object):
+class Tselect(Ttreecache):
     def __init__(self, tree):
         """Initialise TTree selector with tree"""
         assert(tree)
@@ -55,25 +750,494 @@ class Tselect(object):
         del self.shape
         del self._exprs
 
-    def fill_hists(self, opts=''):
-        """Iterate over expressions and fill histograms"""
-        def _get_hist(expr):
-            if not expr[0]:
-                return None
-            self.tree.Draw(expr[0], expr[1], '{} goff'.format(opts))
-            return ROOT.gROOT.FindObject(parse_hist_name(expr[0]))
-        self.hists = [_get_hist(expr) for expr in self._exprs]
+    def _draw(self, expr, opts=''):
+        """Fill histogram for (expression, selection) pair"""
+        if not expr[0]:
+            return None
+        self.tree.Draw(expr[0], expr[1], '{} goff'.format(opts))
+        return ROOT.gROOT.FindObject(parse_hist_name(expr[0]))
+
+    def _fill_parallel(self, opts, nproc, onepass=False):
+        """Fill histograms with a pool of worker processes.
+
+           The entry range is split into chunks, the workers fill the
+           histograms of all expressions for a chunk (reading the tree
+           from their own handle), and the results are merged with
+           TH1::Add.  Expressions w/o binning info are filled in this
+           process, since every worker would choose its own binning.
+           Empty copies of existing histograms are sent to the workers
+           for their binning.  Workers are spawned, not forked, since
+           ROOT (or our I/O threads) may have threads running.
+
+        """
+        import multiprocessing
+        elist = self.tree.GetEventList() or self.tree.GetEntryList()
+        nentries = elist.GetN() if elist else self.tree.GetEntries()
+        names = [parse_hist_name(expr[0]) if expr[0] else None
+                 for expr in self._exprs]
+        par = [i for i, expr in enumerate(self._exprs) if expr[0] and
+               (has_binning(expr[0]) or ROOT.gROOT.FindObject(names[i]))]
+        hists = [None if i in par else self._draw(expr, opts)
+                 for i, expr in enumerate(self._exprs)]
+        if not (par and nentries):
+            return [self._draw(expr, opts) if i in par else hists[i]
+                    for i, expr in enumerate(self._exprs)]
+
+        # workers start afresh, continue filling after merging
+        exprs = [(self._exprs[i][0].replace('>>+', '>>', 1),
+                  self._exprs[i][1]) for i in par]
+        templates = []
+        for i in par:
+            hist = ROOT.gROOT.FindObject(names[i])
+            if hist:
+                hist = hist.Clone()
+                hist.Reset()
+                hist.SetDirectory(0)
+            templates.append(hist or None)
+        name, files = tree_source(self.tree)
+        step = -(-nentries // min(4*nproc, nentries))  # ceil
+        chunks = [(name, files, elist, exprs, templates, opts, first, step,
+                   onepass) for first in range(0, nentries, step)]
+        pool = multiprocessing.get_context('spawn').Pool(nproc)
+        try:
+            results = pool.starmap(_fill_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+        for j, i in enumerate(par):
+            filled = [res[j] for res in results if res[j]]
+            if not filled:
+                continue
+            merged = filled[0]
+            for res in filled[1:]:
+                merged.Add(res)
+            hist = ROOT.gROOT.FindObject(names[i])
+            if hist:            # like TTree::Draw, reuse existing
+                if self._exprs[i][0].find('>>+') < 0:
+                    hist.Reset()
+                hist.Add(merged)
+            else:
+                hist = merged
+                hist.SetDirectory(ROOT.gDirectory)
+            hists[i] = hist
+        return hists
+
+    @profiled('Tselect.fill_hists')
+    def fill_hists(self, opts='', nproc=1, onepass=False):
+        """Iterate over expressions and fill histograms
+
+           opts    -- options passed on to TTree::Draw(..)
+           nproc   -- fill with a pool of nproc worker processes
+           onepass -- fill all histograms in one pass over the tree
+                      (see fill_formulas(..)), expressions that can't
+                      be filled this way fall back to TTree::Draw(..)
+
+        """
+        exprs = [expr[1] for expr in self._exprs]
+        for expr in self._exprs:
+            exprs += split_varexp(expr[0].partition('>>')[0])
+        if nproc > 1 and not tree_source(self.tree):
+            nproc = 1           # in memory, workers cannot read it
+        with self._cacheop('fill_hists', exprs):
+            if nproc > 1:
+                self.hists = self._fill_parallel(opts, nproc, onepass)
+            elif onepass:
+                hists = fill_formulas(self.tree, self._exprs)
+                self.hists = [hist or self._draw(expr, opts)
+                              for hist, expr in zip(hists, self._exprs)]
+            else:
+                self.hists = [self._draw(expr, opts)
+                              for expr in self._exprs]
         return self.hists
 
+
+def _chunks(tree, nentries, chunksize):
+    """Split entries in (first, nentries) chunks of about chunksize.
+
+       Chunks end at cluster boundaries, unless the tree is a chain,
+       or has an entry list (first then refers to the list).
+
+    """
+    if isinstance(tree, ROOT.TChain) or \
+       tree.GetEventList() or tree.GetEntryList():
+        for first in range(0, nentries, chunksize):
+            yield first, min(chunksize, nentries - first)
+        return
+    clusters = tree.GetClusterIterator(0)
+    first = start = clusters()
+    while start < nentries:
+        stop = min(clusters.GetNextEntry(), nentries)
+        if stop <= start:       # no progress, shouldn't happen
+            stop = nentries
+        if stop - first >= chunksize or stop >= nentries:
+            yield first, stop - first
+            first = stop
+        start = clusters()
+
+
+def _runs(entries):
+    """Return run starts, and stops (exclusive) for sorted entries"""
+    import numpy as np
+    if not entries.size:
+        return entries, entries
+    breaks = np.flatnonzero(np.diff(entries) != 1) + 1
+    return (entries[np.r_[0, breaks]],
+            entries[np.r_[breaks - 1, entries.size - 1]] + 1)
+
+
+def _merge_runs(starts, stops):
+    """Sort runs, and merge overlapping (or adjacent) runs"""
+    import numpy as np
+    keep = stops > starts
+    starts, stops = starts[keep], stops[keep]
+    if starts.size > 1:
+        order = np.argsort(starts, kind='mergesort')
+        starts, stops = starts[order], stops[order]
+        stops = np.maximum.accumulate(stops)
+        new = np.r_[True, starts[1:] > stops[:-1]]
+        last = np.r_[new[1:], True]
+        starts, stops = starts[new], stops[last]
+    return starts, stops
+
+
+def _complement_runs(starts, stops, size):
+    """Return runs in [0, size) not covered by sorted, disjoint runs"""
+    import numpy as np
+    starts, stops = np.r_[0, stops], np.r_[starts, size]
+    keep = stops > starts
+    return starts[keep], stops[keep]
+
+
+def _runs_op(runs1, runs2, op, size):
+    """Union (`|'), intersection (`&'), or difference (`-') of runs"""
+    import numpy as np
+    if op == '-':
+        runs2 = _complement_runs(runs2[0], runs2[1], size)
+    elif op == '|':
+        return _merge_runs(np.r_[runs1[0], runs2[0]],
+                           np.r_[runs1[1], runs2[1]])
+    # A ∩ B = ~(~A ∪ ~B)
+    runs1 = _complement_runs(runs1[0], runs1[1], size)
+    runs2 = _complement_runs(runs2[0], runs2[1], size)
+    union = _merge_runs(np.r_[runs1[0], runs2[0]], np.r_[runs1[1], runs2[1]])
+    return _complement_runs(union[0], union[1], size)
+
+
+# Tbitmap blocks: 2**16 entries, stored as a container of uint16 runs
+# (start, length - 1), or a packed bitmap, whichever is smaller
+_block_bits = 16
+_block_size = 1 << _block_bits
+
+
+def _container(starts, stops):
+    """Return container for sorted, disjoint runs (offsets in a block),
+       None if there are no entries"""
+    import numpy as np
+    if not starts.size:
+        return None
+    if 4 * starts.size < _block_size // 8:
+        return np.array([starts, stops - starts - 1], dtype=np.uint16)
+    edges = np.zeros(_block_size + 1, dtype=np.int8)
+    edges[starts] = 1
+    edges[stops] = -1
+    return np.packbits(np.cumsum(edges[:-1]) > 0)
+
+
+def _container_runs(container):
+    """Return run starts, and stops (offsets in the block)"""
+    import numpy as np
+    if container is None:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    if container.ndim == 2:
+        starts = container[0].astype(np.int64)
+        return starts, starts + container[1] + 1
+    edges = np.diff(np.r_[0, np.unpackbits(container), 0].astype(np.int8))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def _container_count(container):
+    """Number of entries in a container"""
+    if container.ndim == 2:
+        return int(container[1].sum()) + container.shape[1]
+    import numpy as np
+    return int(np.unpackbits(container).sum())
+
+
+_fill_entrylist_code = """
+#include "TEntryList.h"
+#include "TTree.h"
+
+void rplot_fill_entrylist(TEntryList* elist, TTree* tree,
+                          const Long64_t* starts, const Long64_t* stops,
+                          Long64_t nruns)
+{
+  for (Long64_t i = 0; i < nruns; ++i) {
+    for (Long64_t entry = starts[i]; entry < stops[i]; ++entry) {
+      elist->Enter(entry, tree);
+    }
+  }
+}
+"""
+
+
+def _fill_entrylist(elist, tree, starts, stops):
+    """Enter runs of entries in entry list (compiled, if possible)"""
+    if not hasattr(ROOT, 'rplot_fill_entrylist'):
+        ROOT.gInterpreter.Declare(_fill_entrylist_code)
+    fill = getattr(ROOT, 'rplot_fill_entrylist', None)
+    if fill:
+        fill(elist, tree, starts, stops, starts.size)
+    else:
+        for start, stop in zip(starts.tolist(), stops.tolist()):
+            for entry in range(start, stop):
+                elist.Enter(entry, tree)
+
+
+class Tbitmap(object):
+    """Compact set of entries of a tree.
+
+       >>> bitmap = Tbitmap.from_tree(tree, 'foo>42')
+       >>> bitmap.GetN()
+       >>> both = bitmap & Tbitmap.from_tree(tree, 'bar<42')
+
+       Entries are global entry numbers (of the chain), stored in
+       blocks of 2**16 entries, like roaring bitmaps: a block is kept
+       as runs of consecutive entries (4 bytes a run), or as a packed
+       bitmap (1 bit an entry), whichever is smaller.  Empty blocks
+       are not stored.  A bitmap behaves like an entry list where it
+       matters (GetN, Add, Subtract, Intersect, Clone), so it can be
+       used as a splice, see Tsplice.make_splice(..).  The TEntryList
+       needed to apply it to a tree is only created when asked for,
+       see entrylist(..).
+
+    """
+
+    def __init__(self, starts=(), stops=(), nentries=0, name=''):
+        """Bitmap from runs (need not be sorted, or disjoint)"""
+        import numpy as np
+        self.name = name
+        self._elist = None
+        self._set_runs(np.asarray(starts, dtype=np.int64),
+                       np.asarray(stops, dtype=np.int64), nentries)
+
+    def _set_runs(self, starts, stops, nentries):
+        """Set blocks from runs, after sorting and merging them"""
+        import numpy as np
+        starts, stops = _merge_runs(starts, stops)
+        blocks = {}
+        if starts.size:
+            # split runs at block boundaries
+            first = starts >> _block_bits
+            npieces = ((stops - 1) >> _block_bits) - first + 1
+            run = np.repeat(np.arange(starts.size), npieces)
+            block = np.arange(npieces.sum()) - \
+                np.repeat(np.cumsum(npieces) - npieces - first, npieces)
+            base = block << _block_bits
+            pstarts = np.maximum(starts[run], base) - base
+            pstops = np.minimum(stops[run], base + _block_size) - base
+            bounds = np.flatnonzero(np.diff(block)) + 1
+            for key, bstarts, bstops in zip(block[np.r_[0, bounds]].tolist(),
+                                            np.split(pstarts, bounds),
+                                            np.split(pstops, bounds)):
+                blocks[key] = _container(bstarts, bstops)
+        self._set_blocks(blocks, max(nentries, int(stops[-1])
+                                     if stops.size else 0))
+
+    def _set_blocks(self, blocks, nentries):
+        self._blocks = blocks
+        self.nentries = nentries
+        self._elist = None
+
+    @classmethod
+    def _from_blocks(cls, blocks, nentries, name=''):
+        bitmap = cls(name=name)
+        bitmap._set_blocks(blocks, nentries)
+        return bitmap
+
+    @classmethod
+    def from_entries(cls, entries, nentries=0, name=''):
+        """Bitmap from an array of entry numbers"""
+        import numpy as np
+        entries = np.unique(np.asarray(entries, dtype=np.int64))
+        return cls(*_runs(entries), nentries=nentries, name=name)
+
+    @classmethod
+    def from_tree(cls, tree, selection='', name='', chunksize=1000000):
+        """Bitmap of entries that pass selection.
+
+           The tree is read in chunks (of clusters), and only the
+           branches used by the selection are read.  The current entry
+           list of the tree is respected.
+
+        """
+        import numpy as np
+        from utils import rbuffer
+        if isinstance(selection, ROOT.TCut):
+            selection = selection.GetTitle()
+        selection = str(selection or '')
+        branches = formula_branches(tree, selection) if selection else set()
+        if branches is None:
+            raise ValueError('Invalid selection: {}'.format(selection))
+        elist = tree.GetEventList() or tree.GetEntryList()
+        nentries = elist.GetN() if elist else tree.GetEntries()
+        bitmap = cls(nentries=tree.GetEntries(), name=name)
+        estimate = tree.GetEstimate()
+        try:
+            with branch_mask(tree, branches):
+                for first, size in _chunks(tree, nentries, chunksize):
+                    tree.SetEstimate(size)
+                    nrows = tree.Draw('Entry$', selection, 'goff', size, first)
+                    if nrows > tree.GetEstimate():  # array selection
+                        tree.SetEstimate(nrows)
+                        nrows = tree.Draw('Entry$', selection, 'goff', size,
+                                          first)
+                    entries = rbuffer(tree.GetV1(), max(nrows, 0))
+                    entries = np.unique(entries.astype(np.int64))
+                    # only blocks at the chunk edges are merged
+                    bitmap.Add(cls(*_runs(entries)))
+        finally:
+            tree.SetEstimate(estimate)
+        return bitmap
+
+    def GetName(self):
+        return self.name
+
+    def SetName(self, name):
+        self.name = name
+
+    def GetN(self):
+        """Number of entries"""
+        return sum(_container_count(cont) for cont in self._blocks.values())
+
+    def Clone(self, name=''):
+        # containers are never modified in place, share them
+        return Tbitmap._from_blocks(dict(self._blocks), self.nentries,
+                                    name or self.name)
+
+    @property
+    def nbytes(self):
+        """Memory used by the blocks (bytes)"""
+        return sum(cont.nbytes for cont in self._blocks.values())
+
+    def runs(self):
+        """Return arrays of run starts, and stops (exclusive)"""
+        import numpy as np
+        starts, stops = [], []
+        for key in sorted(self._blocks):
+            runs = _container_runs(self._blocks[key])
+            starts.append(runs[0] + (key << _block_bits))
+            stops.append(runs[1] + (key << _block_bits))
+        return (np.concatenate(starts or [[]]).astype(np.int64),
+                np.concatenate(stops or [[]]).astype(np.int64))
+
+    def entries(self):
+        """Return array of entry numbers"""
+        import numpy as np
+        starts, stops = self.runs()
+        lengths = stops - starts
+        offsets = np.cumsum(lengths) - lengths
+        return np.arange(lengths.sum(), dtype=np.int64) + \
+            np.repeat(starts - offsets, lengths)
+
+    def __contains__(self, entry):
+        import numpy as np
+        cont = self._blocks.get(entry >> _block_bits)
+        if cont is None:
+            return False
+        pos = entry & (_block_size - 1)
+        if cont.ndim == 2:
+            i = np.searchsorted(cont[0], pos, side='right') - 1
+            return i >= 0 and pos <= int(cont[0, i]) + int(cont[1, i])
+        return bool((cont[pos >> 3] >> (7 - (pos & 7))) & 1)
+
+    def complement(self, nentries=0):
+        """Return bitmap of entries (< nentries) not in this one"""
+        nentries = max(nentries, self.nentries)
+        blocks = {}
+        for key in range(-(-nentries // _block_size)):  # ceil
+            size = min(_block_size, nentries - (key << _block_bits))
+            runs = _container_runs(self._blocks.get(key))
+            cont = _container(*_complement_runs(runs[0], runs[1], size))
+            if cont is not None:
+                blocks[key] = cont
+        return Tbitmap._from_blocks(blocks, nentries)
+
+    def _combine(self, other, op):
+        """Combine blocks with op (`|', `&', or `-')"""
+        keys = set(self._blocks)
+        if op == '|':
+            keys |= set(other._blocks)
+        elif op == '&':
+            keys &= set(other._blocks)
+        blocks = {}
+        for key in keys:
+            mine, theirs = self._blocks.get(key), other._blocks.get(key)
+            if theirs is None or mine is None:  # `|', or `-'
+                cont = mine if theirs is None else theirs
+            else:
+                cont = _container(*_runs_op(_container_runs(mine),
+                                            _container_runs(theirs), op,
+                                            _block_size))
+            if cont is not None:
+                blocks[key] = cont
+        return Tbitmap._from_blocks(blocks, max(self.nentries,
+                                                other.nentries))
+
+    def __or__(self, other):
+        return self._combine(other, '|')
+
+    def __and__(self, other):
+        return self._combine(other, '&')
+
+    def __sub__(self, other):
+        return self._combine(other, '-')
+
+    def _update(self, other):
+        self._set_blocks(other._blocks, other.nentries)
+
+    def Add(self, other):
+        self._update(self | other)
+
+    def Intersect(self, other):
+        self._update(self & other)
+
+    def Subtract(self, other):
+        self._update(self - other)
+
+    def entrylist(self, tree):
+        """Return (cached) TEntryList for tree, see release()"""
+        from utils import root_addr
+        if self._elist and self._elist[0] == root_addr(tree):
+            return self._elist[1]
+        elist = ROOT.TEntryList(self.name, '')
+        elist.SetDirectory(0)
+        _fill_entrylist(elist, tree, *self.runs())
+        self._elist = (root_addr(tree), elist)
+        return elist
+
+    def release(self):
+        """Delete the TEntryList, do not call while it is in use"""
+        self._elist = None
+
+
 empty_expr = ('', '')
 
+cutstep = namedtuple('cutstep',
+                     'name cut entries sumw eff cumeff weff wcumeff')
+cutstep.__doc__ = """Step of a cut flow: number of entries (and sum of weights)
+after the cut, efficiency w.r.t. the previous step, and all entries, and
+the same efficiencies with weights"""
+
 
-class Tsplice(object):
+class Tsplice(Ttreecache):
     """Implements splices for ROOT trees.
 
        This is not real splicing, it emulates the behaviour by
        maintaining an internal list of entry lists (e.g. TEventList,
-       TEntryList, and TEntryListArray).
+       TEntryList, and TEntryListArray), or compact bitmaps of
+       entries (Tbitmap).
 
        >>> mysplice = Tsplice(tree)
        >>> spliced_tree1 = mysplice.make_splice(name1, 'foo<42')
@@ -93,20 +1257,36 @@ class Tsplice(object):
        Otherwise it is easy to loose track of which entry list was
        created with what selection.
 
+       While making a splice, only the branches used in the selection
+       are read; set the prune property to False to read all of them.
+
+       Splices can be combined without reading the tree again.
+       >>> mysplice.intersection(name3, name1, name2)
+       >>> spliced_tree3 = mysplice.get_splice(name3)
+
+       Splices can be cached on disk across sessions, see Tsplicecache.
+       >>> mysplice = Tsplice(tree, cache=Tsplicecache('splices.root'))
+
     """
 
     elists = {}
+    prune = True
+
+    def __init__(self, tree, layered=False, cache=None):
+        """When layered is True, do not reset before creating new splices.
 
-    def __init__(self, tree, layered=False):
-        """When layered is True, do not reset before creating new splices"""
+           cache -- Tsplicecache to look up (and store) splices
+
+        """
         self.tree = tree
         self.layered = layered
+        self.cache = cache
         self.elists['all'] = tree.GetEntryList()
         self.current = self.elists['all']
 
     def reset(self):
         """Reset last splice to all entries"""
-        self.tree.SetEntryList(self.elists['all'])
+        self._apply(self.elists['all'])
         self.current = self.elists['all']
         return self.tree
 
@@ -114,15 +1294,31 @@ class Tsplice(object):
         """Return the number of entries in current slice"""
         return self.current.GetN()
 
-    def set_splice(self, elist):
-        """Set entry list as splice"""
-        if isinstance(elist, ROOT.TEventList):
+    def _apply(self, elist):
+        """Apply entry list (or bitmap) to the tree.
+
+           Only the TEntryList of the bitmap applied to the tree is
+           kept, it is released once it is replaced.
+
+        """
+        applied = self.__dict__.get('_applied')
+        if isinstance(elist, Tbitmap):
+            self.tree.SetEntryList(elist.entrylist(self.tree))
+        elif isinstance(elist, ROOT.TEventList):
             self.tree.SetEventList(elist)
         else:
             self.tree.SetEntryList(elist)
+        if applied is not None and applied is not elist:
+            applied.release()
+        self._applied = elist if isinstance(elist, Tbitmap) else None
+
+    def set_splice(self, elist):
+        """Set entry list (or bitmap) as splice"""
+        self._apply(elist)
         self.current = elist
         return self.tree
 
+    @profiled('Tsplice.make_splice')
     def make_splice(self, name, selection, listtype='entrylist', append=False):
         """Create and return a spliced tree as per selection.
 
@@ -132,9 +1328,9 @@ class Tsplice(object):
                         selection string or a TCut object.
 
            listtype  -- type of splice to create, supported types are
-                        TEventList, TEntryList, and TEntryListArray,
-                        selected by: '', 'entrylist', and
-                        'tentrylistarray', respectively.
+                        TEventList, TEntryList, TEntryListArray, and
+                        Tbitmap, selected by: '', 'entrylist',
+                        'tentrylistarray', and 'bitmap', respectively.
 
            append    -- if append is true, continue filling any existing
                         splice.
@@ -142,6 +1338,9 @@ class Tsplice(object):
            NOTE: when not in layered mode, self.reset() is called before
            creating a new slice.
 
+           When there is a cache, it is used unless appending, or
+           splicing on top of an existing splice (layered mode).
+
         """
         import uuid
         if not name:
@@ -152,7 +1351,7 @@ class Tsplice(object):
         assert(selection)
         listtype = listtype.lower()
         # empty for TEventList
-        assert(listtype in ['', 'entrylist', 'entrylistarray'])
+        assert(listtype in ['', 'entrylist', 'entrylistarray', 'bitmap'])
 
         if not self.layered:
             self.reset()
@@ -160,12 +1359,34 @@ class Tsplice(object):
             if self.layered and self.current != self.elists['all']:
                 print('Tsplice is in layered mode, last splice was not `all\','
                       ' make sure this is what you want')
-            self.tree.Draw('>>+{}'.format(name), selection, listtype)
+            redirect = '>>+{}'
         else:
-            self.tree.Draw('>>{}'.format(name), selection, listtype)
+            redirect = '>>{}'
+        cached = self.cache and not append and not self.current and \
+            listtype != 'bitmap'
+        elist = cached and self.cache.get(self.tree, selection, listtype)
+        if listtype == 'bitmap':
+            with self._cacheop('make_splice', [selection]):
+                elist = Tbitmap.from_tree(self.tree, selection, name)
+            if append and isinstance(self.elists.get(name), Tbitmap):
+                elist.Add(self.elists[name])
+        elif elist:
+            elist.SetName(name)
+            elist.SetDirectory(ROOT.gDirectory)
+        else:
+            branches = None
+            if self.prune:
+                branches = formula_branches(
+                    self.tree, selection.GetTitle()
+                    if isinstance(selection, ROOT.TCut) else selection)
+            with self._cacheop('make_splice', [selection]), \
+                    branch_mask(self.tree, branches):
+                self.tree.Draw(redirect.format(name), selection, listtype)
+            elist = ROOT.gDirectory.Get(name)
+            if cached:
+                self.cache.put(self.tree, selection, listtype, elist)
         # should I also keep the selection?
-        self.elists[name] = ROOT.gDirectory.Get(name)
-        self.current = self.elists[name]
+        self.elists[name] = elist
         return self.set_splice(self.elists[name])
 
     def get_splice(self, name):
@@ -179,3 +1400,281 @@ class Tsplice(object):
         except KeyError:
             print('unknown entry list:', name)
         return self.tree
+
+    def _all_entries(self, like):
+        """Return list of all entries of the same type as like; it is
+           not attached to a directory, and deleted with its last
+           reference"""
+        import uuid
+        name = 'elist_{}'.format(uuid.uuid4().hex)
+        listtype = '' if isinstance(like, ROOT.TEventList) else 'entrylist'
+        current = self.current
+        self.reset()
+        with branch_mask(self.tree, []):  # no need to read anything
+            self.tree.Draw('>>{}'.format(name), '', listtype)
+        elist = ROOT.gDirectory.Get(name)
+        elist.SetDirectory(0)
+        ROOT.SetOwnership(elist, True)
+        self.set_splice(current)
+        return elist
+
+    def _as_bitmap(self, elist):
+        """Return splice as a bitmap"""
+        if isinstance(elist, Tbitmap):
+            return elist
+        if not elist:
+            return Tbitmap([0], [self.tree.GetEntries()])
+        current = self.current
+        self.set_splice(elist)
+        bitmap = Tbitmap.from_tree(self.tree)
+        self.set_splice(current)
+        return bitmap
+
+    def _combine(self, name, names, combine):
+        """Combine splices with combine(result, other) into a new splice"""
+        elists = [self.elists[other] for other in names]
+        kinds = set(isinstance(elist, ROOT.TEventList)
+                    for elist in elists if elist)
+        if any(isinstance(elist, Tbitmap) for elist in elists):
+            elists = [self._as_bitmap(elist) for elist in elists]
+        elif len(kinds) > 1:
+            raise TypeError('Cannot combine TEventList and TEntryList '
+                            'splices: {}'.format(', '.join(names)))
+        if not kinds:           # only all entries
+            elists = [self._all_entries(None)] * len(elists)
+        elif not all(elists):
+            every = self._all_entries(next(el for el in elists if el))
+            elists = [elist or every for elist in elists]
+        if name in self.elists:
+            print('Tsplice: existing entry list will be overwritten!')
+        result = elists[0].Clone(name)
+        for elist in elists[1:]:
+            combine(result, elist)
+        self.elists[name] = result
+        return result
+
+    def union(self, name, *names):
+        """Create splice with entries in any of the named splices.
+
+           The entry lists are combined in memory, without reading the
+           tree; the new splice is not applied, use get_splice(..).
+           Returns the new entry list.
+
+        """
+        return self._combine(name, names, lambda res, el: res.Add(el))
+
+    def intersection(self, name, *names):
+        """Create splice with entries in all named splices, see union(..)"""
+        def intersect(result, elist):
+            if isinstance(result, (ROOT.TEventList, Tbitmap)):
+                result.Intersect(elist)
+            else:               # A ∩ B = A - (A - B)
+                diff = result.Clone()
+                diff.SetDirectory(0)
+                diff.Subtract(elist)
+                result.Subtract(diff)
+                del diff
+        return self._combine(name, names, intersect)
+
+    def difference(self, name, *names):
+        """Create splice with entries in the first named splice, but not
+           in the others, see union(..)"""
+        return self._combine(name, names, lambda res, el: res.Subtract(el))
+
+    def cutflow(self, cuts, weight=None, chunksize=100000):
+        """Make splices for every step of a cut flow in one pass.
+
+           cuts      -- ordered list of (name, cut) pairs, every cut is
+                        applied on top of the previous ones
+           weight    -- expression for entry weights (default: 1)
+           chunksize -- entries read at a time, see iterate(..)
+
+           Cuts are evaluated per entry; the number of consecutive
+           cuts an entry passes is computed with one expression, so the
+           tree is read only once.  The splices (bitmaps, see Tbitmap)
+           are named after the steps.  As with make_splice(..), the
+           cut flow starts from all entries, unless in layered mode.
+
+           Cuts, and the weight, must have one value per entry; reduce
+           arrays first, e.g. `Sum$(data>100)>0', or `Max$(data)>100'.
+
+           Returns list of cutstep, starting with `all' entries.
+
+        """
+        import numpy as np
+        if not self.layered:
+            self.reset()
+        names = [name for name, cut in cuts]
+        cuts = [cut.GetTitle() if isinstance(cut, ROOT.TCut) else str(cut)
+                for name, cut in cuts]
+        if not self.tree.GetTree():  # chain w/o a loaded tree
+            self.tree.LoadTree(0)
+        for expr in cuts + ([weight] if weight else []):
+            form = ROOT.TTreeFormula('cutflow', str(expr), self.tree)
+            if not form.GetNdim():
+                raise ValueError('Invalid expression: {}'.format(expr))
+            if form.GetMultiplicity():
+                raise ValueError('Array-valued expression: {}, reduce it per '
+                                 'entry (e.g. with Sum$, or Max$)'
+                                 .format(expr))
+        # c1*(1+c2*(1+...)), number of cuts passed in a row
+        step = '0'
+        for cut in reversed(cuts):
+            step = '(({})!=0)*(1+{})'.format(cut, step)
+        columns = ['Entry$', step] + ([weight] if weight else [])
+        counts = np.zeros(len(cuts) + 1)
+        sumw = np.zeros(len(cuts) + 1)
+        runs = [([], []) for cut in cuts]
+        with self._cacheop('cutflow', cuts + [weight]):
+            for chunk in iterate(self.tree, columns, chunksize):
+                entries = chunk['Entry$'].astype(np.int64)
+                steps = chunk[step].astype(np.int64)
+                counts += np.bincount(steps, minlength=len(cuts) + 1)
+                sumw += np.bincount(steps, chunk[weight] if weight else None,
+                                    minlength=len(cuts) + 1)
+                for i, (starts, stops) in enumerate(runs):
+                    run = _runs(entries[steps > i])
+                    starts.append(run[0])
+                    stops.append(run[1])
+        # entries that pass step i, pass all steps before it
+        counts = np.cumsum(counts[::-1])[::-1]
+        sumw = np.cumsum(sumw[::-1])[::-1]
+
+        nentries = self.tree.GetEntries()
+        for name, (starts, stops) in zip(names, runs):
+            if name in self.elists:
+                print('Tsplice: existing entry list will be overwritten!')
+            self.elists[name] = Tbitmap(np.concatenate(starts or [[]]),
+                                        np.concatenate(stops or [[]]),
+                                        nentries, name)
+        res = []
+        for i, (name, cut) in enumerate(zip(['all'] + names, [''] + cuts)):
+            prev = (counts[i-1], sumw[i-1]) if i else (counts[0], sumw[0])
+            res.append(cutstep(name, cut, int(counts[i]), sumw[i],
+                               counts[i] / prev[0] if prev[0] else 0.,
+                               counts[i] / counts[0] if counts[0] else 0.,
+                               sumw[i] / prev[1] if prev[1] else 0.,
+                               sumw[i] / sumw[0] if sumw[0] else 0.))
+        return res
+
+
+class Tsplicecache(object):
+    """Persistent cache of splices (entry lists) in a ROOT file.
+
+       >>> cache = Tsplicecache('splices.root')
+       >>> elist = cache.get(tree, 'foo>42', 'entrylist')
+       >>> if not elist:
+       ...     tree.Draw('>>elist', 'foo>42', 'entrylist')
+       ...     cache.put(tree, 'foo>42', 'entrylist', gDirectory.Get('elist'))
+
+       Splices are keyed by the tree (name, files, and a fingerprint
+       of the files, see utils.file_hash(..)), the list type, and the
+       normalised selection.  Entries for files that have changed are
+       dropped, and the least recently used entries are evicted to
+       keep at most maxentries.  Trees read from non-local files are
+       not cached.  Lookups only read the cache file; access times of
+       hits are written with the next put(..).
+
+    """
+
+    def __init__(self, filename, maxentries=256):
+        self.filename = filename
+        self.maxentries = maxentries
+        self._atimes = {}       # hits not yet written to the index
+
+    @staticmethod
+    def normalise(selection):
+        """Normalise selection (TCut, whitespace)"""
+        if isinstance(selection, ROOT.TCut):
+            selection = selection.GetTitle()
+        return ''.join(str(selection).split())
+
+    @staticmethod
+    def fingerprint(filename):
+        """Return fingerprint of file, None if not a local file"""
+        from utils import file_hash
+        try:
+            return file_hash(filename, fast=True)
+        except (IOError, OSError):
+            return None
+
+    def key(self, tree, selection, listtype):
+        """Return (key name, metadata) for splice, None if not cacheable"""
+        import hashlib
+        import json
+        source = tree_source(tree)
+        if not source:
+            return None
+        name, files = source
+        fingerprints = [self.fingerprint(fname) for fname in files]
+        if None in fingerprints:
+            return None
+        meta = {'tree': name, 'files': files, 'fingerprints': fingerprints,
+                'selection': self.normalise(selection),
+                'listtype': listtype.lower()}
+        digest = hashlib.sha1(json.dumps(meta, sort_keys=True).encode())
+        return ('elist_{}'.format(digest.hexdigest()), meta)
+
+    @staticmethod
+    def _read_index(rfile):
+        import json
+        index = rfile.Get('index')
+        return json.loads(index.GetString().Data()) if index else {}
+
+    @staticmethod
+    def _write_index(rfile, index):
+        import json
+        rfile.WriteTObject(ROOT.TObjString(json.dumps(index)), 'index',
+                           'Overwrite')
+
+    def get(self, tree, selection, listtype):
+        """Return cached entry list (not attached to any directory)"""
+        import os
+        import time
+        from rdir import savepwd
+        key = self.key(tree, selection, listtype)
+        if not key or not os.path.exists(self.filename):
+            return None
+        with savepwd():
+            rfile = ROOT.TFile.Open(self.filename, 'read')
+            index = self._read_index(rfile)
+            elist = rfile.Get(key[0]) if key[0] in index else None
+            if elist:
+                elist.SetDirectory(0)
+                self._atimes[key[0]] = time.time()
+            rfile.Close()
+        return elist
+
+    def put(self, tree, selection, listtype, elist):
+        """Store entry list in cache"""
+        import time
+        from rdir import savepwd
+        key = self.key(tree, selection, listtype)
+        if not key:
+            return
+        name, meta = key
+        with savepwd():
+            rfile = ROOT.TFile.Open(self.filename, 'update')
+            index = self._read_index(rfile)
+            # invalidate entries for files that have changed
+            stale = [old for old, info in index.items()
+                     if info['tree'] == meta['tree'] and
+                     info['files'] == meta['files'] and
+                     info['fingerprints'] != meta['fingerprints']]
+            for old in stale:
+                del index[old]
+            for old, atime in self._atimes.items():
+                if old in index:
+                    index[old]['atime'] = max(atime, index[old]['atime'])
+            self._atimes.clear()
+            meta['atime'] = time.time()
+            index[name] = meta
+            lru = sorted(index, key=lambda old: index[old]['atime'])
+            evict = lru[:max(0, len(index) - self.maxentries)]
+            for old in evict:
+                del index[old]
+            for old in stale + evict:
+                rfile.Delete('{};*'.format(old))
+            rfile.WriteTObject(elist, name, 'Overwrite')
+            self._write_index(rfile, index)
+            rfile.Close()
@@ -1,6 +1,8 @@
 # coding=utf-8
 """Utilities"""
 
+from rprof import profiled
+
 
 def is_type(key, rtype):
     """Is key the ROOT type `rtype''?"""
@@ -14,6 +16,15 @@ def is_dir(key):
     return is_type(key, TDirectoryFile)
 
 
+def root_addr(obj):
+    """Address of the C++ object behind a PyROOT proxy"""
+    import ROOT
+    try:
+        return ROOT.addressof(obj)
+    except AttributeError:      # old PyROOT
+        return ROOT.AddressOf(obj)[0]
+
+
 def root_str(objs):
     """String representation for ROOT objects"""
     fmt = '{cls}({nm})'
@@ -157,6 +168,89 @@ def thnbincentre(hist, i, edges=False, width=False):
 try:
     import numpy as np
 
+    # TArray base of histogram storage, and the matching numpy type
+    _tarray_dtypes = (('TArrayD', 'f8'), ('TArrayF', 'f4'), ('TArrayI', 'i4'),
+                      ('TArrayS', 'i2'), ('TArrayC', 'i1'), ('TArrayL64', 'i8'))
+
+    def rbuffer(buf, size, dtype='f8', copy=False):
+        """Return numpy.array view of a C++ buffer (e.g. Double_t*).
+
+           buf   -- buffer as returned by PyROOT (TArrayD::GetArray(),
+                    TGraph::GetX(), etc)
+           size  -- number of elements in the buffer
+           dtype -- numpy type of the elements
+           copy  -- return a copy instead of a view
+
+        NOTE: a view does not keep the owning ROOT object alive.
+
+        """
+        if size <= 0:
+            return np.zeros(0, dtype=dtype)
+        if hasattr(buf, 'reshape'):     # cppyy LowLevelView
+            view = buf.reshape((size,))
+            if view is not None:        # newer cppyy returns a new view
+                buf = view
+        elif hasattr(buf, 'SetSize'):   # PyROOT buffer (old PyROOT)
+            buf.SetSize(size)
+        val = np.frombuffer(buf, dtype=dtype, count=size)
+        return val.copy() if copy else val
+
+    def _thnstorage(hist):
+        """Return numpy type of histogram storage, None if unsupported"""
+        import ROOT
+        # contents of profiles are not the bin contents
+        if any(hist.InheritsFrom(cls) for cls in
+               ('TProfile', 'TProfile2D', 'TProfile3D')):
+            return None
+        for cls, dtype in _tarray_dtypes:
+            tarray_t = getattr(ROOT, cls, None)
+            if tarray_t and isinstance(hist, tarray_t):
+                return dtype
+        return None
+
+    def thncells(hist, sumw2=False, copy=False):
+        """Return histogram cells (incl. under/overflow) as numpy.array.
+
+           The array is in global bin order, and is a view of the
+           histogram storage unless copy is True.  Returns None if the
+           storage is not supported (e.g. profiles, or when sumw2 is
+           requested but the histogram does not have it).
+
+           hist  -- histogram
+           sumw2 -- return the sum of squares of weights instead
+           copy  -- return a copy
+
+        """
+        dtype = _thnstorage(hist)
+        if dtype is None:
+            return None
+        if hist.GetBufferSize():  # same as TH1::GetBinContent(..)
+            hist.BufferEmpty()
+        ncells = hist.GetNcells()
+        if sumw2:
+            if not hist.GetSumw2N():
+                return None
+            return rbuffer(hist.GetSumw2().GetArray(), ncells, 'f8', copy)
+        return rbuffer(hist.GetArray(), ncells, dtype, copy)
+
+    def thncellshape(hist):
+        """Shape of histogram cells in global bin order, i.e. [z][y][x]"""
+        shape = (hist.GetNbinsZ() + 2, hist.GetNbinsY() + 2,
+                 hist.GetNbinsX() + 2)
+        return shape[3 - hist.GetDimension():]
+
+    def _thnbinscan(hist, err=False, asym=False):
+        """Return histogram cells by calling TH1::GetBin* for each bin"""
+        getters = [hist.GetBinContent]
+        if err and asym:
+            getters += [hist.GetBinErrorUp, hist.GetBinErrorLow]
+        elif err:
+            getters.append(hist.GetBinError)
+        hiter = range(hist.GetNcells())
+        return [np.array([get(i) for i in hiter], dtype=float)
+                for get in getters]
+
+    @profiled('thn2array')
     def thn2array(hist, err=False, asym=False, pair=False, shaped=False,
                   overflow=False):
         """Convert ROOT histograms to numpy.array
@@ -164,59 +258,156 @@ try:
            hist -- histogram to convert
            err  -- include bin errors
            asym -- Asymmetric errors
-           pair -- pair bin errors with bin content, by default errors
-                   are put in a similarly shaped array in res[1]
+           pair -- pair bin errors with bin content (last index), by
+                   default errors are put in a similarly shaped array in
+                   res[1] (first index)
          shaped -- return an array with appropriate dimensions, 1-D
                    array is returned normally
        overflow -- include underflow and overflow bins
+
+        Shaped contents are indexed as [z][y][x], with or w/o pair, e.g.
+        for a 2D histogram with errors, the shape is (ny, nx, 2) when
+        paired, and (2, ny, nx) otherwise.
+
+        The contents (and sum of weights squared) are read from the
+        histogram storage in one go; only profiles, histograms with
+        non-normal errors, or unknown storage fall back to reading
+        bin by bin.
+
         """
-        if shaped:
-            xbins = hist.GetNbinsX()
-            ybins = hist.GetNbinsY()
-            zbins = hist.GetNbinsZ()
-            # add overflow, underflow bins
-            overflow *= 2
-            if ybins == 1:
-                shape = [xbins + overflow]
-            elif zbins == 1:
-                shape = [xbins + overflow, ybins + overflow]
-            else:
-                shape = [xbins + overflow, ybins + overflow, zbins + overflow]
+        from ROOT import TH1
+        cells = thncells(hist)
+        if cells is None or \
+           (err and hist.GetBinErrorOption() != TH1.kNormal):
+            cols = _thnbinscan(hist, err, asym)
         else:
-            shape = [len(hist)]
-            if not overflow:
-                shape[0] -= 2
-        if err:
-            shape.append(3 if asym else 2)
-        hiter = range(len(hist)) if overflow else range(1, len(hist)-1)
-        val = np.array([thnbincontent(hist, i, err=err, asym=asym)
-                        for i in hiter]).reshape(*shape)
-        return val if pair else val.transpose()
+            cols = [cells]
+            if err:
+                sumw2 = thncells(hist, sumw2=True)
+                if sumw2 is None:
+                    sumw2 = np.abs(cells)
+                error = np.sqrt(sumw2)
+                cols += [error, error] if asym else [error]
+        shape = thncellshape(hist)
+        inner = (slice(None) if overflow else slice(1, -1),) * len(shape)
+        # copy once, also converts to double
+        cols = [np.array(col.reshape(shape)[inner], dtype=float)
+                for col in cols]
+        if not shaped:
+            cols = [col.ravel() for col in cols]
+        val = np.stack(cols, axis=-1) if err else cols[0]
+        return val if pair or not err else np.moveaxis(val, -1, 0)
+
+    # cache of axis binnings, see taxisbins(..)
+    _taxis_cache = {}
+    _taxis_cache_size = 1024
+
+    def taxisbins(axis, overflow=False):
+        """Return bin centres, low edges, and widths of an axis.
+
+           axis     -- axis instance
+           overflow -- include underflow and overflow bins
+
+        The binning is read in one pass (the edge array for variable
+        binning, the range for fixed binning), and cached per axis.
+        The returned arrays are read-only.
+
+        """
+        nbins, xmin, xmax = axis.GetNbins(), axis.GetXmin(), axis.GetXmax()
+        xbins = axis.GetXbins()
+        nedges = xbins.GetSize()
+        key = (root_addr(axis), nbins, xmin, xmax, nedges)
+        if nedges:
+            edges = rbuffer(xbins.GetArray(), nedges)
+        bins = _taxis_cache.get(key)
+        # variable bins can change without changing the key
+        if bins is None or (nedges and
+                            not np.array_equal(bins[1][1:-1], edges[:-1])):
+            if not nedges:
+                edges = np.linspace(xmin, xmax, nbins + 1)
+            # under/overflow bins are like TAxis::GetBin*(..)
+            step = (xmax - xmin) / nbins
+            widths = np.diff(edges)
+            bins = (np.concatenate(([xmin - step/2.], edges[:-1] + widths/2.,
+                                    [xmax + step/2.])),
+                    np.concatenate(([xmin - step], edges[:-1], [xmax])),
+                    np.concatenate((widths[:1], widths, widths[-1:])))
+            for val in bins:
+                val.flags.writeable = False
+            if len(_taxis_cache) >= _taxis_cache_size:
+                _taxis_cache.clear()
+            _taxis_cache[key] = bins
+        return bins if overflow else tuple(val[1:-1] for val in bins)
+
+    def thnaxes(hist, overflow=False):
+        """Return taxisbins(..) for all axes of histogram (X, Y, Z)"""
+        axes = (hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis())
+        return [taxisbins(axis, overflow)
+                for axis in axes[:hist.GetDimension()]]
 
     def thnbins(hist, edges=False, width=False, pair=False, overflow=False):
-        """Return histogram bin centre or edges"""
-        hiter = range(len(hist)) if overflow else range(1, len(hist)-1)
-        val = np.array([thnbincentre(hist, i, edges=edges, width=width)
-                        for i in hiter])
-        return val if pair else val.transpose()
+        """Return histogram bin centre or edges.
+
+           hist     -- histogram
+           edges    -- also return bin low edges
+           width    -- also return bin width
+           pair     -- pair centre, edges, and widths for every bin
+           overflow -- include underflow and overflow bins
+
+        For 2D and 3D histograms, a list with the result for every
+        axis (X, Y, Z) is returned.
+
+        """
+        res = []
+        for centres, lows, widths in thnaxes(hist, overflow):
+            cols = [centres]
+            if edges:
+                cols.append(lows)
+            if width:
+                cols.append(widths)
+            if len(cols) > 1:
+                val = np.stack(cols)
+                res.append(val.transpose() if pair else val)
+            else:
+                res.append(centres)
+        return res[0] if len(res) == 1 else res
 
     def thnprint(hist, err=False, asym=False, pair=False, shaped=True):
         """Print ROOT histograms of any dimention"""
         val = thn2array(hist, err=err, asym=asym, pair=pair, shaped=shaped)
         print('Hist: {}, dim: {}'.format(hist.GetName(), len(np.shape(val))))
         hist.Print()
-        print(np.flipud(val))  # flip y axis, FIXME: check what happens for 3D
+        dim = hist.GetDimension()
+        if shaped and dim > 1:  # flip y axis, so it increases upwards
+            val = np.flip(val, axis=dim - 2 + (err and not pair))
+        print(val)
 
 except ImportError:
     import warnings
     # warnings.simplefilter('always')
     msg = 'Could not import numpy.\n'
-    msg += 'Unavailable functions: thn2array, thnbins, thnprint.'
+    msg += 'Unavailable functions: rbuffer, thncells, thncellshape, '
+    msg += 'thn2array, taxisbins, thnaxes, thnbins, thnprint.'
     warnings.warn(msg, ImportWarning)
 
+    def rbuffer(buf, size, dtype, copy):
+        raise NotImplementedError('Not available without numpy')
+
+    def thncells(hist, sumw2, copy):
+        raise NotImplementedError('Not available without numpy')
+
+    def thncellshape(hist):
+        raise NotImplementedError('Not available without numpy')
+
     def thn2array(hist, err, asym, pair, shaped):
         raise NotImplementedError('Not available without numpy')
 
+    def taxisbins(axis, overflow):
+        raise NotImplementedError('Not available without numpy')
+
+    def thnaxes(hist, overflow):
+        raise NotImplementedError('Not available without numpy')
+
     def thnbins(hist, edges, width, pair):
         raise NotImplementedError('Not available without numpy')
 
@@ -269,12 +460,98 @@ def _import_args(namespace, d={}):
     return d
 
 
-def file_hash(filename):
-    """Calculate MD5 hash of file based on contents"""
+def _hasher(algorithm):
+    """Return hash object for algorithm (hashlib, or xxhash if installed)"""
     import hashlib
+    if algorithm.startswith('xxh'):
+        import xxhash
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def _root_keys_span(myfile, size):
+    """Return (seek, nbytes) of top level key list in ROOT file, or None"""
+    import struct
+    myfile.seek(0)
+    header = myfile.read(64)
+    if len(header) < 64 or header[:4] != b'root':
+        return None
+    version, begin = struct.unpack_from('>ii', header, 4)
+    # fEND, fSeekFree, fNbytesFree, nfree, fNbytesName
+    fmt = '>qqiii' if version > 1000000 else '>iiiii'
+    nbytesname = struct.unpack_from(fmt, header, 12)[-1]
+    # top directory: version, fDatimeC, fDatimeM, fNbytesKeys, fNbytesName,
+    # fSeekDir, fSeekParent, fSeekKeys
+    myfile.seek(begin + nbytesname)
+    record = myfile.read(42)
+    if len(record) < 42:
+        return None
+    dversion, nbyteskeys = struct.unpack_from('>h8xi', record, 0)
+    if dversion > 1000:
+        seekkeys = struct.unpack_from('>q', record, 34)[0]
+    else:
+        seekkeys = struct.unpack_from('>i', record, 26)[0]
+    if 0 < seekkeys and 0 < nbyteskeys and seekkeys + nbyteskeys <= size:
+        return (seekkeys, nbyteskeys)
+    return None
+
+
+# memoised hashes, see file_hash(..)
+_file_hashes = {}
+
+
+def file_hash(filename, algorithm='md5', chunksize=1 << 20, fast=False):
+    """Calculate hash of file based on contents.
+
+       filename  -- file to hash
+       algorithm -- hashlib algorithm (e.g. 'blake2b' is faster than
+                    'md5' on 64-bit machines), or an xxhash algorithm
+                    (e.g. 'xxh3_64') if the xxhash module is installed
+       chunksize -- read (and hash) file in chunks of this many bytes
+       fast      -- fingerprint mode, only hash the header, the top level
+                    key list (ROOT files), the tail, and the file size
+
+    The file is memory mapped when possible, and hashed chunk by
+    chunk, so memory use is bounded by chunksize.  Results are
+    memoised per (path, mtime, size).
+
+    """
+    import os
+    import mmap
+    stat = os.stat(filename)
+    memo = (os.path.realpath(filename), stat.st_mtime, stat.st_size,
+            algorithm, chunksize if fast else None)
+    if memo in _file_hashes:
+        return _file_hashes[memo]
+
+    size = stat.st_size
+    hasher = _hasher(algorithm)
     with open(filename, 'rb') as myfile:
-        contents = myfile.read()
-        return hashlib.md5(contents).hexdigest()
+        if fast:
+            hasher.update(str(size).encode())
+            spans = [(0, chunksize), _root_keys_span(myfile, size),
+                     (max(0, size - chunksize), chunksize)]
+            spans = [span for span in spans if span]
+        else:
+            spans = [(0, size)]
+        try:
+            buf = mmap.mmap(myfile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):  # empty, or not mappable
+            buf = None
+        for start, nbytes in spans:
+            end = min(start + nbytes, size)
+            for pos in range(start, end, chunksize):
+                if buf is None:
+                    myfile.seek(pos)
+                    hasher.update(myfile.read(min(chunksize, end - pos)))
+                else:
+                    view = memoryview(buf)
+                    hasher.update(view[pos:min(pos + chunksize, end)])
+                    view.release()
+        if buf is not None:
+            buf.close()
+    _file_hashes[memo] = hasher.hexdigest()
+    return _file_hashes[memo]
 
 
 def suppress_warnings():